@@ -1,14 +1,24 @@
 import argparse
 import datetime
 
+import metrics
 from grib import Grib
 TIDE_DAY_SEC = datetime.timedelta(hours=24, minutes=50).total_seconds()
 
 
+def parse_start_time(start_date_utc):
+    for fmt in ('%Y-%m-%d %H:%M', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(start_date_utc, fmt)
+        except ValueError:
+            pass
+    raise ValueError(f'Start date {start_date_utc} is neither YYYY-MM-DD nor YYYY-MM-DD HH:MM')
+
+
 def make_const_wind_grib(args):
     grib = Grib(args.currents_src_grib, args.work_dir)
     dates = grib.get_dates()
-    start_date = datetime.datetime.strptime(args.start_date_utc, '%Y-%m-%d')
+    start_date = parse_start_time(args.start_date_utc)
 
     # Find the closest date separated by the integer number of 24 hours and 50 minutes
     delta_sec = (start_date - dates[0]).total_seconds()
@@ -21,12 +31,43 @@ def make_const_wind_grib(args):
     grib.adjust_time(dates_map, args.currents_out_grib)
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+def make_rephased_currents_grib(args):
+    """ Writes currents at every step from the start time, interpolated by the tidal phase of the source GRIB """
+    grib = Grib(args.currents_src_grib, args.work_dir)
+    start_time = parse_start_time(args.start_date_utc)
+    hours = args.hours
+    if hours is None:
+        dates = grib.get_dates()
+        hours = (max(dates) - min(dates)).total_seconds() / 3600
+    step = datetime.timedelta(minutes=args.step_minutes)
+    steps_num = int(hours * 3600 // step.total_seconds()) + 1
+    target_times = [start_time + n * step for n in range(steps_num)]
+    grib.rephase(target_times, datetime.timedelta(seconds=TIDE_DAY_SEC), args.currents_out_grib)
+
+
+def add_arguments(parser):
     parser.add_argument("--currents-src-grib", help="Original currents GRIB file", required=True)
     parser.add_argument("--currents-out-grib", help="Output currents GRIB file", required=True)
-    parser.add_argument("--start-date-utc", help="GRIB UTC start date YYYY-MM-DD", required=True)
+    parser.add_argument("--start-date-utc", help="GRIB UTC start date YYYY-MM-DD or YYYY-MM-DD HH:MM", required=True)
+    parser.add_argument("--mode", help="shift: move the whole GRIB by whole tide days, "
+                                       "phase: interpolate GRIB2 currents to the times by the tidal phase",
+                        choices=['shift', 'phase'], default='shift')
+    parser.add_argument("--hours", help="Hours of currents to write in phase mode, the GRIB span by default",
+                        type=float, required=False)
+    parser.add_argument("--step-minutes", help="Time step of the currents written in phase mode", type=int,
+                        default=60)
     parser.add_argument("--work-dir", help="Directory to keep clips", default='./data')
-    params, unknown = parser.parse_known_args()
-    make_const_wind_grib(params)
 
+
+def main(args):
+    if args.mode == 'phase':
+        make_rephased_currents_grib(args)
+    else:
+        make_const_wind_grib(args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+    add_arguments(parser)
+    metrics.add_arguments(parser)
+    metrics.run(parser.parse_known_args()[0], main)
@@ -0,0 +1,388 @@
+""" Times the hot paths of the scripts on synthetic HRRR like GRIB2 files and compares them with a saved baseline
+
+    python3 benchmark.py --save-baseline data/benchmark.json
+    python3 benchmark.py --baseline data/benchmark.json
+
+Every benchmark runs in a fresh process, so its peak RSS is not polluted by the fixtures or the other benchmarks.
+The exit code is 1 when a benchmark got slower than the baseline by more than --tolerance.
+"""
+import argparse
+import concurrent.futures
+import datetime
+import importlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import field_store
+import grib2
+import grib_index
+
+# (ni, nj) of the synthetic Lambert grids, 'hrrr' is the full CONUS grid
+SIZES = {
+    'small': (200, 150),
+    'medium': (600, 400),
+    'hrrr': (1799, 1059),
+}
+BUCKET_NAME = 'noaa-hrrr-bdp-pds'
+START_TIME = datetime.datetime(2023, 7, 28, 0)
+HOURS_NUM = 24
+MEMBERS_NUM = 8
+BBOX = ((41.0, 42.0), (-72.0, -70.0))
+
+
+def grib_sec1(ref_time):
+    sec1 = bytearray(21)
+    grib2.put_unsigned(sec1, 0, 4, 21)
+    sec1[4] = 1
+    grib2.put_unsigned(sec1, 5, 2, 7)
+    sec1[9:12] = bytes([2, 1, 1])
+    grib2.set_ref_time(sec1, ref_time)
+    sec1[20] = 1
+    return bytes(sec1)
+
+
+def grib_sec3(ni, nj):
+    """ Lambert conformal grid with the HRRR projection and 3 km spacing, the lower left corner near Long Island """
+    sec3 = bytearray(81)
+    grib2.put_unsigned(sec3, 0, 4, 81)
+    sec3[4] = 3
+    grib2.put_unsigned(sec3, 6, 4, ni * nj)
+    grib2.put_unsigned(sec3, 12, 2, 30)
+    sec3[14] = 6
+    grib2.put_unsigned(sec3, 30, 4, ni)
+    grib2.put_unsigned(sec3, 34, 4, nj)
+    if (ni, nj) == SIZES['hrrr']:
+        la1, lo1 = 21.138123, 237.280472
+    else:
+        la1, lo1 = 39.5, 285.5
+    grib2.put_signed(sec3, 38, 4, round(la1 * 1e6))
+    grib2.put_unsigned(sec3, 42, 4, round(lo1 * 1e6))
+    sec3[46] = 0x08
+    grib2.put_signed(sec3, 47, 4, 38500000)
+    grib2.put_unsigned(sec3, 51, 4, 262500000)
+    grib2.put_unsigned(sec3, 55, 4, 3000000)
+    grib2.put_unsigned(sec3, 59, 4, 3000000)
+    sec3[64] = 0x40
+    grib2.put_signed(sec3, 65, 4, 38500000)
+    grib2.put_signed(sec3, 69, 4, 38500000)
+    return bytes(sec3)
+
+
+def grib_sec4(category, number, surface, level):
+    """ Product definition template 4.0 of the analysis """
+    sec4 = bytearray(34)
+    grib2.put_unsigned(sec4, 0, 4, 34)
+    sec4[4] = 4
+    sec4[9:12] = bytes([category, number, 2])
+    sec4[17] = 1
+    sec4[22] = surface
+    grib2.put_signed(sec4, 24, 4, level)
+    sec4[28] = 255
+    return bytes(sec4)
+
+
+def synthetic_wind(ni, nj, hour, seed):
+    """ Smooth U and V [m/s] fields drifting with time """
+    j, i = np.mgrid[0:nj, 0:ni]
+    phase = 2 * np.pi * hour / 24 + seed
+    u = 5 + 4 * np.sin(i / 37 + phase) * np.cos(j / 53)
+    v = 2 + 3 * np.cos(j / 41 - phase) * np.sin(i / 61 + seed)
+    return u, v
+
+
+def hour_messages(ni, nj, ref_time, seed=0, extra=False):
+    """ Returns list of (wgrib2 inventory name, message) of one HRRR analysis hour """
+    sec1 = grib_sec1(ref_time)
+    sec3 = grib_sec3(ni, nj)
+    u, v = synthetic_wind(ni, nj, ref_time.hour, seed)
+    fields = [('UGRD:10 m above ground', (2, 2, 103, 10), u, 1), ('VGRD:10 m above ground', (2, 3, 103, 10), v, 1)]
+    if extra:
+        tmp = 290 + u - v
+        fields = [('TMP:2 m above ground', (0, 0, 103, 2), tmp, 1)] + fields + [('TMP:surface', (0, 0, 1, 0), tmp, 1)]
+    return [(name, grib2.build_message(0, [sec1, sec3, grib_sec4(*pds), grib2.encode_data(values, scale)]))
+            for name, pds, values, scale in fields]
+
+
+def write_day_grib(grib_name, ni, nj, start_time, seed=0):
+    with open(grib_name, 'wb') as f:
+        for hour in range(HOURS_NUM):
+            for name, message in hour_messages(ni, nj, start_time + datetime.timedelta(hours=hour), seed):
+                f.write(message)
+
+
+def write_bucket(root, ni, nj, start_time):
+    """ Writes HRRR analysis files with wgrib2 style .idx files laid out like the AWS bucket """
+    for hour in range(HOURS_NUM):
+        t = start_time + datetime.timedelta(hours=hour)
+        key = f'hrrr.{t:%Y%m%d}/conus/hrrr.t{t:%H}z.wrfsfcf00.grib2'
+        path = os.path.join(root, BUCKET_NAME, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        offset = 0
+        with open(path, 'wb') as f, open(path + '.idx', 'w') as idx:
+            for num, (name, message) in enumerate(hour_messages(ni, nj, t, extra=True), start=1):
+                idx.write(f'{num}:{offset}:d={t:%Y%m%d%H}:{name}:anl:\n')
+                f.write(message)
+                offset += len(message)
+
+
+def make_fixtures(work_dir, size):
+    ni, nj = SIZES[size]
+    fixtures = {
+        'day_grib': os.path.join(work_dir, 'day.grib2'),
+        'toc_grib': os.path.join(work_dir, 'toc.grib2'),
+        'store_grib': os.path.join(work_dir, 'store.grib2'),
+        'highway_dir': os.path.join(work_dir, 'highway'),
+        's3_dir': os.path.join(work_dir, 's3'),
+    }
+    print(f'Writing {size} ({ni} x {nj}) fixtures to {work_dir} ...')
+    write_day_grib(fixtures['day_grib'], ni, nj, START_TIME)
+    os.makedirs(fixtures['highway_dir'], exist_ok=True)
+    for member in range(MEMBERS_NUM):
+        write_day_grib(os.path.join(fixtures['highway_dir'], f'hrrr-{member:02d}.grib2'), ni // 4, nj // 4,
+                       START_TIME, seed=member)
+    write_bucket(fixtures['s3_dir'], ni, nj, START_TIME)
+
+    # Separate copies, so that the cold TOC read and the decoding are not served from the index or the store
+    shutil.copyfile(fixtures['day_grib'], fixtures['toc_grib'])
+    shutil.copyfile(fixtures['day_grib'], fixtures['store_grib'])
+    grib_index.load_inventory(fixtures['day_grib'])
+    field_store.build_store(fixtures['store_grib'])
+    return fixtures
+
+
+def first_grid(grib_name):
+    with open(grib_name, 'rb') as f:
+        offset, length, edition = next(grib2.scan_messages(f))
+        f.seek(offset)
+        message = grib2.Message(f.read(length))
+    return message.buf, message.section(3)
+
+
+def random_points(grid, num):
+    """ Returns times, lats and lons of random points inside the day GRIB """
+    rng = np.random.default_rng(1)
+    lats, lons = grid.latlon(rng.uniform(0, grid.nj - 1, num), rng.uniform(0, grid.ni - 1, num))
+    seconds = rng.uniform(0, (HOURS_NUM - 1) * 3600, num).astype(np.int64)
+    times = np.datetime64(START_TIME, 's') + seconds.astype('timedelta64[s]')
+    return np.sort(times), lats, lons
+
+
+# Every benchmark takes the fixtures and the output directory and returns (items processed, unit of items)
+
+def bench_toc_cold(fixtures, out_dir):
+    from grib import Grib
+    if os.path.exists(grib_index.index_name(fixtures['toc_grib'])):
+        os.unlink(grib_index.index_name(fixtures['toc_grib']))
+    toc = Grib(fixtures['toc_grib']).read_grib_toc()
+    return len(toc), 'slots'
+
+
+def bench_toc_indexed(fixtures, out_dir):
+    from grib import Grib
+    toc = Grib(fixtures['day_grib']).read_grib_toc()
+    return len(toc), 'slots'
+
+
+def bench_sample_point(fixtures, out_dir):
+    from grib import Grib
+    grib = Grib(fixtures['day_grib'])
+    times, lats, lons = random_points(grib2.make_grid(*first_grid(fixtures['day_grib'])), 200)
+    for t, lat, lon in zip(times.astype(object), lats, lons):
+        grib.get_wind_from_grib(t, lat, lon)
+    return len(times), 'points'
+
+
+def bench_sample_batch(fixtures, out_dir):
+    from grib import Grib
+    grib = Grib(fixtures['day_grib'])
+    times, lats, lons = random_points(grib2.make_grid(*first_grid(fixtures['day_grib'])), 100000)
+    grib.sample_many(times, lats, lons)
+    return len(times), 'points'
+
+
+def bench_sample_store(fixtures, out_dir):
+    from grib import Grib
+    grib = Grib(fixtures['store_grib'])
+    times, lats, lons = random_points(grib.open_store().grid, 100000)
+    grib.sample_many(times, lats, lons)
+    return len(times), 'points'
+
+
+def bench_force_wind(fixtures, out_dir):
+    from grib import Grib
+    grib = Grib(fixtures['day_grib'])
+    grib.force_wind(15, 220, os.path.join(out_dir, 'const.grib2'), '2024-07-28')
+    return len(grib.read_messages()), 'messages'
+
+
+def bench_adjust_time(fixtures, out_dir):
+    from grib import Grib
+    grib = Grib(fixtures['day_grib'])
+    dates = grib.get_dates()
+    grib.adjust_time({d: d + datetime.timedelta(days=365) for d in dates}, os.path.join(out_dir, 'shifted.grib2'))
+    return len(dates), 'messages'
+
+
+def bench_ensemble(fixtures, out_dir):
+    from make_ens_grib import make_ensemble_grib
+    make_ensemble_grib(fixtures['highway_dir'], os.path.join(out_dir, 'ens.grib2'))
+    return MEMBERS_NUM, 'members'
+
+
+def bench_download_crop(fixtures, out_dir):
+    gribs_from_aws = importlib.import_module('gribs-from-aws')
+    work_dir = os.path.join(out_dir, 'download')
+    os.makedirs(work_dir, exist_ok=True)
+    gribs_from_aws.download_gribs(work_dir, START_TIME, START_TIME, HOURS_NUM, True, 0, 0, BBOX,
+                                  s3_dir=fixtures['s3_dir'])
+    return HOURS_NUM, 'hours'
+
+
+BENCHMARKS = {
+    'toc_cold': bench_toc_cold,
+    'toc_indexed': bench_toc_indexed,
+    'sample_point': bench_sample_point,
+    'sample_batch': bench_sample_batch,
+    'sample_store': bench_sample_store,
+    'force_wind': bench_force_wind,
+    'adjust_time': bench_adjust_time,
+    'ensemble': bench_ensemble,
+    'download_crop': bench_download_crop,
+}
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return rss / 1e6 if sys.platform == 'darwin' else rss / 1e3
+
+
+def run_one(name, fixtures, out_dir):
+    """ Runs the benchmark in this (fresh) process, returns (seconds, items, unit, peak RSS [MB]) """
+    # The scripts print progress, keep the benchmark report readable
+    with open(os.devnull, 'w') as devnull:
+        stdout = sys.stdout
+        sys.stdout = devnull
+        try:
+            start = time.perf_counter()
+            items, unit = BENCHMARKS[name](fixtures, out_dir)
+            seconds = time.perf_counter() - start
+        finally:
+            sys.stdout = stdout
+    return seconds, items, unit, peak_rss_mb()
+
+
+def run_benchmark(name, fixtures, out_dir, repeat):
+    runs = []
+    for _ in range(repeat):
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1,
+                                                    mp_context=multiprocessing.get_context('spawn')) as executor:
+            runs.append(executor.submit(run_one, name, fixtures, out_dir).result())
+    seconds = [r[0] for r in runs]
+    items, unit = runs[0][1], runs[0][2]
+    return {
+        'seconds': min(seconds),
+        'mean_seconds': sum(seconds) / len(seconds),
+        'throughput': items / min(seconds),
+        'unit': f'{unit}/s',
+        'peak_rss_mb': max(r[3] for r in runs),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """ Prints the results next to the baseline, returns names of the benchmarks slower than the tolerance """
+    regressions = []
+    print(f'{"benchmark":<16}{"seconds":>10}{"throughput":>22}{"RSS MB":>10}{"baseline":>10}{"change":>9}')
+    for name, r in results.items():
+        line = f'{name:<16}{r["seconds"]:>10.3f}{r["throughput"]:>12.1f} {r["unit"]:<9}{r["peak_rss_mb"]:>10.0f}'
+        base = baseline.get(name)
+        if base is not None:
+            change = r['seconds'] / base['seconds'] - 1
+            line += f'{base["seconds"]:>10.3f}{change:>+9.0%}'
+            if change > tolerance:
+                line += '  SLOWER'
+                regressions.append(name)
+            rss_change = r['peak_rss_mb'] / max(base['peak_rss_mb'], 1) - 1
+            if rss_change > tolerance:
+                line += f'  RSS {rss_change:+.0%}'
+        print(line)
+    return regressions
+
+
+def benchmark(args):
+    names = list(BENCHMARKS) if args.only is None else args.only.split(',')
+    for name in names:
+        if name not in BENCHMARKS:
+            raise SystemExit(f'Unknown benchmark {name}, use one of {",".join(BENCHMARKS)}')
+
+    work_dir = tempfile.mkdtemp(prefix='gribs-bench-') if args.work_dir is None else args.work_dir
+    out_dir = os.path.join(work_dir, 'out')
+    os.makedirs(out_dir, exist_ok=True)
+    try:
+        fixtures = make_fixtures(work_dir, args.size)
+        results = {}
+        failures = []
+        for name in names:
+            print(f'Running {name} ...')
+            try:
+                results[name] = run_benchmark(name, fixtures, out_dir, args.repeat)
+            except ImportError as ex:
+                # e.g. gribs-from-aws dependencies are not installed
+                print(f'{name} skipped: {ex!r}')
+            except Exception as ex:
+                print(f'{name} failed: {ex!r}')
+                failures.append(name)
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    baseline = {}
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            stored = json.load(f)
+        if stored.get('size') != args.size:
+            print(f'Baseline was recorded with --size {stored.get("size")}, not {args.size}')
+        baseline = stored['results']
+    regressions = compare(results, baseline, args.tolerance)
+
+    report = {
+        'size': args.size,
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'{args.save_baseline} created')
+
+    if failures:
+        print(f'Failed: {", ".join(failures)}')
+    if regressions:
+        print(f'Slower than the baseline: {", ".join(regressions)}')
+    return 1 if failures or regressions else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+    parser.add_argument("--size", help="Size of the synthetic grids", choices=list(SIZES), default='medium')
+    parser.add_argument("--only", help=f"Comma separated benchmarks to run: {','.join(BENCHMARKS)}", required=False)
+    parser.add_argument("--repeat", help="Number of runs of every benchmark, the fastest one is reported", type=int,
+                        default=3)
+    parser.add_argument("--baseline", help="JSON file with the results to compare with", required=False)
+    parser.add_argument("--save-baseline", help="Store the results to this JSON file", required=False)
+    parser.add_argument("--tolerance", help="Allowed slowdown against the baseline, 0.1 is 10%%", type=float,
+                        default=0.1)
+    parser.add_argument("--work-dir", help="Keep the fixtures in this directory instead of a temporary one",
+                        required=False)
+    sys.exit(benchmark(parser.parse_args()))
@@ -0,0 +1,286 @@
+""" Reduces the ensemble GRIB (or the directory of highway GRIBs) to the GRIB of summary fields
+
+For every valid time the members are read one by one and the statistics are updated online, so the memory depends
+on the grid size only:
+  UGRD, VGRD  mean of the members (template 4.2)
+  WIND        speed percentiles from per point histograms (template 4.6)
+  WDIR        circular standard deviation of the direction (template 4.2)
+
+Optionally the K most representative members are chosen by k-means clustering of the members winds and written as
+a smaller ensemble GRIB.
+"""
+import argparse
+import glob
+import os
+
+import numpy as np
+
+import field_store
+import grib2
+import grib_index
+import make_ens_grib
+import metrics
+
+WIND_VARS = field_store.WIND_VARS
+WIND_LEVEL = field_store.WIND_LEVEL
+
+# See https://www.nco.ncep.noaa.gov/pmb/docs/grib2/grib2_doc/grib2_table4-7.shtml
+DERIVED_MEAN = 0
+DERIVED_STD = 2
+
+
+def read_members(ens_grib=None, highway_dir=None):
+    """ Returns {valid time: {member: {var: (grib name, record)}}} of the 10 m wind in the ensemble GRIB or in the
+    highway GRIBs, the member of a highway GRIB is its number in the sorted directory listing
+    """
+    if ens_grib is not None:
+        sources = [(ens_grib, None)]
+    else:
+        sources = [(grib_file, num + 1) for num, grib_file in enumerate(sorted(glob.glob(highway_dir + '/*.grib2')))]
+
+    times = {}
+    for grib_name, member in sources:
+        for record in grib_index.load_inventory(grib_name):
+            if record['var'] in WIND_VARS and record['level'] == WIND_LEVEL:
+                grib2.check_record(record)
+                m = record['member'] if member is None else member
+                times.setdefault(record['valid_time'], {}).setdefault(m, {})[record['var']] = (grib_name, record)
+    return times
+
+
+class Reader:
+    """ Decodes the records keeping the GRIB files open """
+    def __init__(self):
+        self.files = {}
+
+    def field(self, grib_name, record):
+        if grib_name not in self.files:
+            self.files[grib_name] = open(grib_name, 'rb')
+        f = self.files[grib_name]
+        f.seek(record['offset'])
+        message = grib2.Message(f.read(record['length']), record['offset'])
+        metrics.count('grib.fields_decoded')
+        return message.fields()[record['field']]
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+
+class WindStats:
+    """ Online mean, speed histogram and direction spread of the members at every grid point """
+    def __init__(self, num_points, speed_bin, max_speed, max_count):
+        self.speed_bin = speed_bin
+        self.bins_num = int(np.ceil(max_speed / speed_bin)) + 1
+        self.n = np.zeros(num_points, dtype=np.int64)
+        self.sum_u = np.zeros(num_points)
+        self.sum_v = np.zeros(num_points)
+        self.sum_cos = np.zeros(num_points)
+        self.sum_sin = np.zeros(num_points)
+        # The last bin counts everything above max_speed
+        self.hist = np.zeros((self.bins_num, num_points), dtype=np.uint16 if max_count < 2 ** 16 else np.uint32)
+        self.points = np.arange(num_points)
+
+    def add(self, u, v):
+        u = u.ravel().astype(np.float64)
+        v = v.ravel().astype(np.float64)
+        valid = ~(np.isnan(u) | np.isnan(v))
+        speed = np.hypot(u, v)
+        self.n += valid
+        self.sum_u += np.where(valid, u, 0)
+        self.sum_v += np.where(valid, v, 0)
+        moving = valid & (speed > 0)
+        self.sum_cos += np.divide(u, speed, out=np.zeros_like(u), where=moving)
+        self.sum_sin += np.divide(v, speed, out=np.zeros_like(v), where=moving)
+        b = np.minimum((speed[valid] / self.speed_bin).astype(np.int64), self.bins_num - 1)
+        self.hist[b, self.points[valid]] += 1
+
+    def mean_uv(self):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.sum_u / self.n, self.sum_v / self.n
+
+    def direction_spread(self):
+        """ Circular standard deviation [deg] """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            r = np.minimum(np.hypot(self.sum_cos, self.sum_sin) / self.n, 1)
+            return np.degrees(np.sqrt(np.abs(2 * np.log(r))))
+
+    def speed_percentile(self, percentile):
+        """ Speed [m/s] interpolated within the histogram bin, max speed if it falls in the overflow bin """
+        cum = np.cumsum(self.hist, axis=0, dtype=np.int64)
+        target = percentile / 100 * self.n
+        b = np.minimum(np.sum(cum < target, axis=0), self.bins_num - 1)
+        below = np.where(b > 0, cum[np.maximum(b - 1, 0), self.points], 0)
+        count = self.hist[b, self.points].astype(np.float64)
+        frac = np.divide(target - below, count, out=np.zeros(len(self.points)), where=count > 0)
+        speed = (b + np.where(b < self.bins_num - 1, frac, 0)) * self.speed_bin
+        return np.where(self.n > 0, speed, np.nan)
+
+
+def kmeans(x, k, iterations=100, seed=0):
+    """ Returns (labels, centers) of the k-means clustering of the rows of x, initialized with k-means++ """
+    rng = np.random.default_rng(seed)
+    centers = [x[rng.integers(len(x))]]
+    for _ in range(1, k):
+        d = np.min([np.sum((x - c) ** 2, axis=1) for c in centers], axis=0)
+        if d.sum() == 0:
+            break
+        centers.append(x[rng.choice(len(x), p=d / d.sum())])
+    centers = np.array(centers)
+
+    labels = None
+    for _ in range(iterations):
+        d = np.sum(x ** 2, axis=1)[:, np.newaxis] - 2 * x @ centers.T + np.sum(centers ** 2, axis=1)
+        new_labels = np.argmin(d, axis=1)
+        if labels is not None and np.array_equal(labels, new_labels):
+            break
+        labels = new_labels
+        for c in range(len(centers)):
+            if np.any(labels == c):
+                centers[c] = x[labels == c].mean(axis=0)
+    return labels, centers
+
+
+def representative_members(features, members, k):
+    """ Returns list of (member, cluster size) with the member closest to the center of each cluster, the largest
+    clusters first
+    """
+    x = features.reshape(len(members), -1)
+    labels, centers = kmeans(x, min(k, len(members)))
+    result = []
+    for c in range(len(centers)):
+        idx = np.flatnonzero(labels == c)
+        if len(idx) == 0:
+            continue
+        best = idx[np.argmin(np.sum((x[idx] - centers[c]) ** 2, axis=1))]
+        result.append((members[best], len(idx)))
+    return sorted(result, key=lambda r: -r[1])
+
+
+def make_stats_grib(times, stats_grib, percentiles, speed_bin, max_speed, cluster_points=0):
+    """ Writes the summary GRIB, returns (members, features) with the wind of every member at up to cluster_points
+    grid points and every valid time when cluster_points > 0
+    """
+    members = sorted({m for by_member in times.values() for m in by_member})
+    features = None
+    sample = None
+    reader = Reader()
+    print(f'Writing statistics of {len(members)} members at {len(times)} times to {stats_grib}')
+    try:
+        with open(stats_grib, 'wb') as out:
+            for t_idx, valid_time in enumerate(sorted(times)):
+                by_member = times[valid_time]
+                stats = None
+                template = None
+                with metrics.span('ens_stats.reduce', time=str(valid_time), members=len(by_member)):
+                    for m in sorted(by_member):
+                        if len(by_member[m]) < len(WIND_VARS):
+                            continue
+                        u_field = reader.field(*by_member[m]['UGRD'])
+                        u = u_field.values()
+                        v = reader.field(*by_member[m]['VGRD']).values()
+                        if stats is None:
+                            template = u_field
+                            stats = WindStats(u.size, speed_bin, max_speed, len(members))
+                        stats.add(u, v)
+                        if cluster_points > 0:
+                            if features is None:
+                                sample = np.unique(np.linspace(0, u.size - 1, min(cluster_points, u.size)).astype(int))
+                                features = np.full((len(members), len(times), 2, len(sample)), np.nan,
+                                               dtype=np.float32)
+                            features[members.index(m), t_idx, 0] = u.ravel()[sample]
+                            features[members.index(m), t_idx, 1] = v.ravel()[sample]
+                if stats is None:
+                    continue
+
+                with metrics.span('ens_stats.write', time=str(valid_time)):
+                    shape = (template.grid.nj, template.grid.ni)
+                    ens_size = int(stats.n.max())
+                    if ens_size > grib2.MAX_ENSEMBLE_SIZE:
+                        ens_size = grib2.MISSING_OCTET
+                    mean_u, mean_v = stats.mean_uv()
+                    fields = [
+                        ('UGRD', 2, [DERIVED_MEAN, ens_size], mean_u),
+                        ('VGRD', 2, [DERIVED_MEAN, ens_size], mean_v),
+                    ]
+                    for percentile in percentiles:
+                        fields.append(('WIND', 6, [percentile], stats.speed_percentile(percentile)))
+                    fields.append(('WDIR', 2, [DERIVED_STD, ens_size], stats.direction_spread()))
+                    for var, pds_template, extra, values in fields:
+                        sec4 = grib2.derived_product_definition(template, var, pds_template, extra)
+                        out.write(grib2.make_message(template, values.reshape(shape), product_definition=sec4))
+                        metrics.count('grib.messages_written')
+    finally:
+        reader.close()
+
+    if features is not None:
+        # Members missing a time get the ensemble mean there, so they don't look like outliers
+        missing = np.isnan(features)
+        count = np.sum(~missing, axis=0)
+        mean = np.divide(np.nansum(features, axis=0), count, out=np.zeros(count.shape, dtype=np.float32),
+                         where=count > 0)
+        features = np.where(missing, mean, features)
+    return members, features
+
+
+def write_representatives(representatives, ens_grib, highway_dir, out_grib):
+    """ Writes the chosen members as the ensemble GRIB with the members numbered from 1 """
+    num_of_forecasts = len(representatives)
+    new_num = {m: num + 1 for num, (m, size) in enumerate(representatives)}
+    print(f'Writing {num_of_forecasts} representative members to {out_grib}')
+    with metrics.span('ens_stats.representatives', grib=out_grib), open(out_grib, 'wb') as out:
+        if ens_grib is not None:
+            for message in grib2.read_messages(ens_grib):
+                member = message.fields()[0].member
+                if member in new_num:
+                    out.write(grib2.set_ensemble(message, make_ens_grib.ENS_MEM_TYPE, new_num[member],
+                                                 num_of_forecasts))
+        else:
+            grib_files = sorted(glob.glob(highway_dir + '/*.grib2'))
+            for member, num in sorted(new_num.items(), key=lambda m: m[1]):
+                out.write(make_ens_grib.make_member(grib_files[member - 1], num, num_of_forecasts))
+
+
+def add_arguments(parser):
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--ens-grib", help="Ensemble GRIB")
+    source.add_argument("--highway-dir", help="Directory containing highway GRIBs, every file is a member")
+    parser.add_argument("--stats-grib", help="Output GRIB with the mean, percentiles and direction spread",
+                        required=True)
+    parser.add_argument("--percentiles", help="Wind speed percentiles to write", nargs='+', type=int,
+                        default=[10, 90])
+    parser.add_argument("--speed-bin", help="Histogram bin of the wind speed [m/s]", type=float, default=0.25)
+    parser.add_argument("--max-speed", help="Top of the speed histogram [m/s]", type=float, default=30)
+    parser.add_argument("--representatives", help="Number of representative members to choose by clustering",
+                        type=int, default=0)
+    parser.add_argument("--representatives-grib", help="Output ensemble GRIB of the representative members")
+    parser.add_argument("--cluster-points", help="Grid points per valid time used for the clustering", type=int,
+                        default=500)
+
+
+def main(args):
+    if args.representatives > 0 and args.representatives_grib is None:
+        raise SystemExit('--representatives needs --representatives-grib')
+    if args.representatives > grib2.MAX_ENSEMBLE_SIZE:
+        raise SystemExit(f'--representatives can be at most {grib2.MAX_ENSEMBLE_SIZE}')
+    if args.highway_dir is not None and not os.path.isdir(args.highway_dir):
+        raise SystemExit(f'{args.highway_dir} is not a directory')
+
+    times = read_members(args.ens_grib, args.highway_dir)
+    if len(times) == 0:
+        raise SystemExit(f'No {WIND_LEVEL} {" and ".join(WIND_VARS)} fields found')
+    members, features = make_stats_grib(times, args.stats_grib, args.percentiles, args.speed_bin, args.max_speed,
+                                        args.cluster_points if args.representatives > 0 else 0)
+    if args.representatives > 0:
+        with metrics.span('ens_stats.cluster', members=len(members)):
+            representatives = representative_members(features, members, args.representatives)
+        for member, size in representatives:
+            print(f' Member {member} represents {size} of {len(members)}')
+        write_representatives(representatives, args.ens_grib, args.highway_dir, args.representatives_grib)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+    add_arguments(parser)
+    metrics.add_arguments(parser)
+    metrics.run(parser.parse_args(), main)
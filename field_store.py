@@ -0,0 +1,175 @@
+""" Decoded U/V fields of a GRIB kept as float32 .npy files for memory mapped reads
+
+The store is a directory (<grib>.fields by default) with:
+  meta.json   size and modification time of the GRIB, grid definition, level, valid times, members and the map from
+              the inventory records to the (var, time, member) slots
+  u.npy v.npy (time, member, nj, ni) float32 arrays, NaN where the GRIB has no field
+
+The arrays are opened with mmap, so opening the store costs reading the small JSON file and parallel workers share
+the page cache instead of decoding their own copy of the fields.
+"""
+import argparse
+import datetime
+import json
+import os
+import shutil
+
+import numpy as np
+
+import grib2
+import grib_index
+import metrics
+
+STORE_SUFFIX = '.fields'
+STORE_VERSION = 2
+WIND_VARS = {'UGRD': 'u', 'VGRD': 'v'}
+WIND_LEVEL = '10 m above ground'
+
+
+def store_name(grib_name):
+    return grib_name + STORE_SUFFIX
+
+
+class FieldStore:
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        with open(os.path.join(store_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.times = [datetime.datetime.strptime(t, grib_index.TIME_FORMAT) for t in self.meta['times']]
+        self.members = self.meta['members']
+        self.grid = grib2.make_grid(bytes.fromhex(self.meta['grid']), 0)
+        self.u = np.load(os.path.join(store_dir, 'u.npy'), mmap_mode='r')
+        self.v = np.load(os.path.join(store_dir, 'v.npy'), mmap_mode='r')
+        self.records = {int(idx): tuple(slot) for idx, slot in self.meta['records'].items()}
+
+    def field(self, idx):
+        """ Returns (nj, ni) read only view of the decoded inventory record idx """
+        var, t, m = self.records[idx]
+        return self.u[t, m] if var == 'u' else self.v[t, m]
+
+    def sample_uv(self, times, lats, lons):
+        """ Returns (points, members) arrays of U and V [m/s] at the given times and positions
+
+        U and V are interpolated bilinearly in space and linearly in time, points outside of the store are NaN
+        """
+        times = np.asarray(times).astype('datetime64[s]')
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        u = np.full((len(times), len(self.members)), np.nan)
+        v = np.full((len(times), len(self.members)), np.nan)
+        if len(self.times) == 0:
+            return u, v
+
+        slots = np.array(self.times, dtype='datetime64[s]')
+        k, weight, valid = grib2.time_weights(slots, times)
+        for slot in np.unique(k[valid]):
+            sel = valid & (k == slot)
+            u[sel] = self.grid.interpolate(self.u[slot], lats[sel], lons[sel]).T
+            v[sel] = self.grid.interpolate(self.v[slot], lats[sel], lons[sel]).T
+            if slot + 1 < len(slots) and np.any(weight[sel] > 0):
+                w = weight[sel][:, np.newaxis]
+                u[sel] += w * (self.grid.interpolate(self.u[slot + 1], lats[sel], lons[sel]).T - u[sel])
+                v[sel] += w * (self.grid.interpolate(self.v[slot + 1], lats[sel], lons[sel]).T - v[sel])
+        return u, v
+
+
+def open_store(grib_name, store_dir=None, level=WIND_LEVEL):
+    """ Returns FieldStore of the GRIB level or None if it was not materialized or the GRIB changed since """
+    store_dir = store_name(grib_name) if store_dir is None else store_dir
+    try:
+        st = os.stat(grib_name)
+        store = FieldStore(store_dir)
+    except (OSError, ValueError, KeyError):
+        return None
+    if not is_current(store.meta, st, STORE_VERSION, level):
+        return None
+    return store
+
+
+def is_current(meta, st, version, level):
+    """ Tells if the meta of a cache built from the GRIB with the stat st is of the version and level """
+    return meta.get('version') == version and meta.get('size') == st.st_size \
+        and meta.get('mtime_ns') == st.st_mtime_ns and meta.get('level') == level
+
+
+def build_store(grib_name, store_dir=None, level=WIND_LEVEL):
+    """ Decodes U and V fields of the level into the store directory and returns the opened FieldStore """
+    store_dir = store_name(grib_name) if store_dir is None else store_dir
+    st = os.stat(grib_name)
+    records = grib_index.load_inventory(grib_name)
+    wind = [(idx, r) for idx, r in enumerate(records) if r['var'] in WIND_VARS and r['level'] == level]
+    if len(wind) == 0:
+        raise grib2.Grib2Error(f'{grib_name} has no UGRD or VGRD fields at {level}')
+    grids = {r['grid'] for _, r in wind}
+    if len(grids) > 1:
+        raise grib2.Grib2Error(f'{grib_name} has fields on {len(grids)} different grids')
+    for _, record in wind:
+        grib2.check_record(record)
+
+    grid_hex = wind[0][1]['grid']
+    grid = grib2.make_grid(bytes.fromhex(grid_hex), 0)
+    times = sorted({r['valid_time'] for _, r in wind})
+    members = sorted({r['member'] for _, r in wind})
+    shape = (len(times), len(members), grid.nj, grid.ni)
+    print(f'Materializing {grib_name} to {store_dir} {shape}')
+
+    # Written next to the final directory and renamed, readers never see a partial store
+    tmp_dir = f'{store_dir}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    arrays = {}
+    for name in WIND_VARS.values():
+        arrays[name] = np.lib.format.open_memmap(os.path.join(tmp_dir, f'{name}.npy'), mode='w+',
+                                                 dtype=np.float32, shape=shape)
+        arrays[name][:] = np.nan
+
+    slots = {}
+    with open(grib_name, 'rb') as f:
+        for idx, record in wind:
+            f.seek(record['offset'])
+            message = grib2.Message(f.read(record['length']), record['offset'])
+            name = WIND_VARS[record['var']]
+            t = times.index(record['valid_time'])
+            m = members.index(record['member'])
+            arrays[name][t, m] = message.fields()[record['field']].values()
+            slots[idx] = (name, t, m)
+    for array in arrays.values():
+        array.flush()
+    del arrays
+
+    meta = {
+        'version': STORE_VERSION,
+        'size': st.st_size,
+        'mtime_ns': st.st_mtime_ns,
+        'grid': grid_hex,
+        'level': level,
+        'times': [t.strftime(grib_index.TIME_FORMAT) for t in times],
+        'members': members,
+        'records': slots,
+    }
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    shutil.rmtree(store_dir, ignore_errors=True)
+    os.replace(tmp_dir, store_dir)
+    return FieldStore(store_dir)
+
+
+def add_arguments(parser):
+    parser.add_argument("--grib-file", help="GRIB files to materialize", nargs='+', required=True)
+    parser.add_argument("--store-dir", help="Store directory, <grib-file>.fields by default, single GRIB only",
+                        required=False)
+    parser.add_argument("--level", help="Level of the wind as wgrib2 prints it", default=WIND_LEVEL)
+
+
+def main(args):
+    if args.store_dir is not None and len(args.grib_file) > 1:
+        raise SystemExit('--store-dir can be used with a single --grib-file only')
+    for grib_file in args.grib_file:
+        build_store(grib_file, args.store_dir, args.level)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+    add_arguments(parser)
+    metrics.add_arguments(parser)
+    metrics.run(parser.parse_args(), main)
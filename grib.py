@@ -1,29 +1,94 @@
 import datetime
 import io
-import math
 import os.path
-import shutil
 import subprocess
 
+import numpy as np
+
+import field_store
+import grib2
+import grib_index
+import metrics
+
 WGRIB_BIN = os.path.expanduser('bin/osx/wgrib2')
-GRIB_GET_BIN = '/usr/local/bin/grib_get'
-GRIB_SET_BIN = '/usr/local/bin/grib_set'
+WIND_LEVEL = field_store.WIND_LEVEL
+
+
+def wind_speed_dir(u, v):
+    """ Returns wind speed [kts] and the direction the wind blows from [deg true], as TWD of the instruments """
+    speed_ms = np.sqrt(np.square(u) + np.square(v))
+    speed_kts = speed_ms * 3600 / 1852
+    direction = np.degrees(np.arctan2(-u, -v)) % 360
+    return speed_kts, direction
+
+
+def angle_diff(a, b):
+    """ Signed difference a - b of the angles in degrees, in [-180, 180) """
+    return (np.asarray(a) - np.asarray(b) + 180) % 360 - 180
+
+
+def circular_mean_std(directions, axis=None):
+    """ Returns circular mean and standard deviation [deg] of the directions ignoring NaN """
+    rad = np.radians(directions)
+    with np.errstate(invalid='ignore'):
+        sin = np.nanmean(np.sin(rad), axis=axis) if np.size(rad) else np.nan
+        cos = np.nanmean(np.cos(rad), axis=axis) if np.size(rad) else np.nan
+        mean = np.degrees(np.arctan2(sin, cos)) % 360
+        r = np.minimum(np.hypot(sin, cos), 1)
+        std = np.degrees(np.sqrt(np.abs(2 * np.log(r))))
+    return mean, std
+
+
+def to_datetime64(times):
+    """ Converts list of naive UTC or timezone aware datetimes to numpy datetime64 array """
+    if isinstance(times, np.ndarray) and np.issubdtype(times.dtype, np.datetime64):
+        return times.astype('datetime64[s]')
+    utc_times = []
+    for t in times:
+        if t.tzinfo is not None:
+            t = t.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        utc_times.append(t)
+    return np.array(utc_times, dtype='datetime64[s]')
+
+
+def run_wgrib2(cmd):
+    """ Returns stdout of the wgrib2 command """
+    with metrics.span('subprocess', cmd=' '.join(cmd)):
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        result = process.communicate()[0].decode('utf-8')
+    metrics.count('subprocess.calls')
+    return result
 
 
 class Grib:
-    def __init__(self, grib_name, work_dir=None):
+    def __init__(self, grib_name, work_dir=None, use_wgrib2=False):
         self.grib_name = grib_name
         self.work_dir = work_dir
+        self.use_wgrib2 = use_wgrib2
         self.toc = None
+        self.records = None
+        self.fields = {}
+        self.messages = None
+        self.store = None
+        self.store_checked = False
 
     def read_grib_toc(self):
+        if not self.use_wgrib2:
+            try:
+                with metrics.span('grib.toc', grib=self.grib_name):
+                    return self.read_native_toc()
+            except grib2.Grib2Error as ex:
+                print(f'{self.grib_name}: {ex}, falling back to wgrib2')
+                self.use_wgrib2 = True
+
         cmd = [WGRIB_BIN, self.grib_name]
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        result = process.communicate()[0].decode('utf-8')
+        result = run_wgrib2(cmd)
         toc = {}
         for line in io.StringIO(result):
             t = line.split(':')
             time = datetime.datetime.strptime(t[2], 'd=%Y%m%d%H')
+            if t[4] != WIND_LEVEL:
+                continue
             if time not in toc:
                 toc[time] = {}
             if t[3] == 'UGRD':
@@ -33,6 +98,61 @@ class Grib:
 
         return toc
 
+    def read_native_toc(self):
+        # Same layout as the wgrib2 TOC, but the values are indexes in self.records. Only the first member of an
+        # ensemble GRIB is in the TOC, FieldStore.sample_uv samples all of them.
+        self.records = grib_index.load_inventory(self.grib_name)
+        wind = [r for r in self.records if r['var'] in ('UGRD', 'VGRD') and r['level'] == WIND_LEVEL]
+        member = min((r['member'] for r in wind), default=0)
+        toc = {}
+        for idx, record in enumerate(self.records):
+            if record['level'] != WIND_LEVEL or record['member'] != member:
+                continue
+            time = record['valid_time']
+            if time not in toc:
+                toc[time] = {}
+            if record['var'] == 'UGRD':
+                toc[time]['u'] = idx
+            if record['var'] == 'VGRD':
+                toc[time]['v'] = idx
+
+        # Make sure the wind can be decoded before we commit to the native reader, other records don't matter
+        for slot in toc.values():
+            for idx in slot.values():
+                grib2.check_record(self.records[idx])
+
+        return toc
+
+    def materialize(self, store_dir=None):
+        """ Decodes U and V fields to the memory mapped store, later Grib objects of this file read from it """
+        self.store = field_store.build_store(self.grib_name, store_dir)
+        self.store_checked = True
+        return self.store
+
+    def open_store(self, store_dir=None):
+        """ Returns the up to date FieldStore of this GRIB or None """
+        if not self.store_checked:
+            self.store = field_store.open_store(self.grib_name, store_dir)
+            self.store_checked = True
+        return self.store
+
+    def get_field(self, idx):
+        """ Returns (grid, values) of the decoded field
+
+        Fields are mapped from the materialized store if there is one, otherwise decoded once and kept in memory
+        """
+        store = self.open_store()
+        if store is not None and idx in store.records:
+            return store.grid, store.field(idx)
+        if idx not in self.fields:
+            record = self.records[idx]
+            with metrics.span('grib.decode', grib=self.grib_name, record=idx):
+                message = grib2.read_message(self.grib_name, record['offset'], record['length'])
+                field = message.fields()[record['field']]
+                self.fields[idx] = (field.grid, field.values())
+            metrics.count('grib.fields_decoded')
+        return self.fields[idx]
+
     def get_wind_from_grib(self, utc_time, lat, lon):
         if self.toc is None:
             self.toc = self.read_grib_toc()
@@ -42,12 +162,70 @@ class Grib:
             print(f'date {grib_time} is not part of the GRIB file')
             return None, None
 
+        if not self.use_wgrib2:
+            grid, u = self.get_field(self.toc[grib_time]['u'])
+            _, v = self.get_field(self.toc[grib_time]['v'])
+            j, i, inside = grid.nearest(lat, lon)
+            if not inside:
+                print(f'{lat} {lon} is outside of the GRIB grid')
+                return None, None
+            speed_kts, direction = wind_speed_dir(float(u[j, i]), float(v[j, i]))
+            return float(speed_kts), float(direction)
+
+        return self.get_wind_from_wgrib2(grib_time, lat, lon)
+
+    def sample_many(self, times, lats, lons):
+        """ Returns arrays of wind speed [kts] and direction [deg] at the given times and positions
+
+        U and V are interpolated bilinearly in space and linearly in time, points outside of the GRIB are NaN
+        """
+        if self.toc is None:
+            self.toc = self.read_grib_toc()
+
+        times = to_datetime64(times)
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        u = np.full(len(times), np.nan)
+        v = np.full(len(times), np.nan)
+
+        if self.use_wgrib2:
+            speed = np.full(len(times), np.nan)
+            direction = np.full(len(times), np.nan)
+            for n, t in enumerate(times.astype(object)):
+                s, d = self.get_wind_from_grib(t, lats[n], lons[n])
+                if s is not None:
+                    speed[n], direction[n] = s, d
+            return speed, direction
+
+        slot_times = sorted(t for t in self.toc if 'u' in self.toc[t] and 'v' in self.toc[t])
+        if len(slot_times) == 0:
+            return u, v
+        slots = np.array(slot_times, dtype='datetime64[s]')
+
+        # Each point is interpolated between slot k and k + 1
+        k, weight, valid = grib2.time_weights(slots, times)
+
+        for slot in np.unique(k[valid]):
+            sel = valid & (k == slot)
+            u[sel], v[sel] = self.interpolate_uv(slot_times[slot], lats[sel], lons[sel])
+            if slot + 1 < len(slot_times) and np.any(weight[sel] > 0):
+                u1, v1 = self.interpolate_uv(slot_times[slot + 1], lats[sel], lons[sel])
+                u[sel] += weight[sel] * (u1 - u[sel])
+                v[sel] += weight[sel] * (v1 - v[sel])
+
+        return wind_speed_dir(u, v)
+
+    def interpolate_uv(self, grib_time, lats, lons):
+        grid, u = self.get_field(self.toc[grib_time]['u'])
+        _, v = self.get_field(self.toc[grib_time]['v'])
+        return grid.interpolate(u, lats, lons), grid.interpolate(v, lats, lons)
+
+    def get_wind_from_wgrib2(self, grib_time, lat, lon):
         min_idx = min(self.toc[grib_time]['u'], self.toc[grib_time]['v'])
 
         cmd = [WGRIB_BIN, self.grib_name, '-for', f'{min_idx}:{min_idx+1}', '-lola', f'{lon + 360}:1:1', f'{lat}:1:1',
                '-', 'text']
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        result = process.communicate()[0].decode('utf-8')
+        result = run_wgrib2(cmd)
         lines = io.StringIO(result).readlines()
 
         # Find if the first record is U or V
@@ -60,78 +238,112 @@ class Grib:
 
         u = float(lines[u_idx].strip())
         v = float(lines[v_idx].strip())
-        speed_ms = math.sqrt(u**2 + v**2)
-        speed_kts = speed_ms * 3600 / 1852
-        direction = math.degrees(math.atan2(v, u)) % 360
-        return speed_kts, direction
+        speed_kts, direction = wind_speed_dir(u, v)
+        return float(speed_kts), float(direction)
+
+    def read_messages(self):
+        """ Returns all messages of the GRIB, the file is parsed once and kept in memory """
+        if self.messages is None:
+            with metrics.span('grib.read', grib=self.grib_name):
+                self.messages = list(grib2.read_messages(self.grib_name))
+        return self.messages
 
     def force_wind(self, tws_kts, twd_deg, out_grib_name, start_date_utc):
-        csv_file = 'data/out.csv'
-        txt_file = 'data/in.txt'
-        cmd = [WGRIB_BIN, self.grib_name,  '-no_header', '-csv', csv_file]
-        tws_ms = tws_kts * 1852 / 3600
-        twd_rad = math.radians(twd_deg + 180)
-        u = tws_ms * math.sin(twd_rad)
-        v = tws_ms * math.cos(twd_rad)
+        """ Writes the GRIB with UGRD and VGRD replaced by the given wind
 
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        process.communicate()[0].decode('utf-8')
-
-        with open(csv_file, 'r') as f_cvs, open(txt_file, 'w') as f_txt:
-            for line in f_cvs:
-                t = line.split(',')
-                if t[2] == '"UGRD"':
-                    f_txt.write(f'{u}\n')
-                if t[2] == '"VGRD"':
-                    f_txt.write(f'{v}\n')
-
-        t = start_date_utc.split('-')
-        d = t[0] + t[1] + t[2]  + '00'
-        print(f'Writing {out_grib_name}')
-        cmd = [WGRIB_BIN, self.grib_name, '-no_header',
-               '-set_date', d,
-               '-import_text', txt_file, '-grib_out', out_grib_name]
-        print(f'Running {" ".join(cmd)}')
+        tws_kts and twd_deg are either constants or (nj, ni) arrays matching the template grid
+        """
+        tws_ms = np.asarray(tws_kts, dtype=np.float64) * 1852 / 3600
+        twd_rad = np.radians(np.asarray(twd_deg, dtype=np.float64) + 180)
+        u = tws_ms * np.sin(twd_rad)
+        v = tws_ms * np.cos(twd_rad)
+        start_date = datetime.datetime.strptime(start_date_utc, '%Y-%m-%d')
 
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        result = process.communicate()[0].decode('utf-8')
-        io.StringIO(result).readlines()
+        print(f'Writing {out_grib_name}')
+        with metrics.span('grib.force_wind', grib=out_grib_name), open(out_grib_name, 'wb') as f:
+            for message in self.read_messages():
+                for field in message.fields():
+                    values = None
+                    if field.var == 'UGRD':
+                        values = np.broadcast_to(u, (field.grid.nj, field.grid.ni))
+                    if field.var == 'VGRD':
+                        values = np.broadcast_to(v, (field.grid.nj, field.grid.ni))
+                    f.write(grib2.make_message(field, values, ref_time=start_date))
+                    metrics.count('grib.messages_written')
 
     def adjust_time(self, dates_map,  new_grib_name):
-        # Read current time stamps from the GRIB file
+        """ Copies the GRIB replacing the reference times found in dates_map, in one pass over the file """
+        print(f'Writing {new_grib_name}')
+        with metrics.span('grib.adjust_time', grib=new_grib_name), \
+                open(self.grib_name, 'rb') as f, open(new_grib_name, 'wb') as out:
+            for offset, length, edition in grib2.scan_messages(f):
+                f.seek(offset)
+                message = bytearray(f.read(length))
+                new_date = dates_map.get(grib2.get_message_ref_time(message))
+                if new_date is not None:
+                    grib2.set_message_ref_time(message, new_date)
+                out.write(message)
+                metrics.count('grib.messages_written')
 
-        input_grib_name = self.grib_name
-        count = 0
-        tmp_grib_name = None
-        for orig_date in dates_map:
-            tmp_grib_name = self.work_dir + os.sep + f'tmp{count}.grib'
-            new_date = dates_map[orig_date]
-            cmd = [GRIB_SET_BIN,
-                   '-s', f'dataDate={new_date.strftime("%Y%m%d")},dataTime={new_date.strftime("%H%M")}',
-                   '-w', f'dataDate={orig_date.strftime("%Y%m%d")},dataTime={orig_date.strftime("%H%M")}',
-                   input_grib_name, tmp_grib_name]
-            print(f'Running {" ".join(cmd)}')
-            process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-            result = process.communicate()[0].decode('utf-8')
-            for line in io.StringIO(result):
-                print(line)
-            count += 1
-            input_grib_name = tmp_grib_name
-
-        if tmp_grib_name is not None:
-            shutil.copyfile(tmp_grib_name, new_grib_name)
+    def rephase(self, target_times, period, new_grib_name):
+        """ Writes the GRIB with every field interpolated to the target times by the phase of the period
 
-    def get_dates(self):
-        # Read current time stamps from the GRIB file
+        All fields are decoded once, the target time T gets the fields of T - k * period falling in the first period
+        of the GRIB, linearly interpolated between the two nearest source times. If the GRIB doesn't cover the whole
+        period, the phase between its last time and the first time + period wraps to the first fields.
+        """
+        records = grib_index.load_inventory(self.grib_name)
+        for record in records:
+            grib2.check_record(record)
+        if len({r['grid'] for r in records}) > 1:
+            raise grib2.Grib2Error(f'{self.grib_name} has fields on different grids')
+        keys = sorted({(r['var'], r['level'], r['member']) for r in records})
+        times = sorted({r['valid_time'] for r in records})
+        grid = grib2.make_grid(bytes.fromhex(records[0]['grid']), 0)
 
-        cmd = [GRIB_GET_BIN, '-p', 'dataDate,dataTime', self.grib_name]
-        print(f'Running {" ".join(cmd)}')
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
-        result = process.communicate()[0].decode('utf-8')
-        dates = []
-        for line in io.StringIO(result):
-            t = line.split()
-            d = datetime.datetime.strptime(t[0] + t[1], '%Y%m%d%H')
-            dates.append(d)
+        values = np.full((len(keys), len(times), grid.nj, grid.ni), np.nan, dtype=np.float32)
+        templates = {}
+        with metrics.span('grib.decode', grib=self.grib_name, records=len(records)), \
+                open(self.grib_name, 'rb') as f:
+            for record in records:
+                f.seek(record['offset'])
+                message = grib2.Message(f.read(record['length']), record['offset'])
+                field = message.fields()[record['field']]
+                key = (record['var'], record['level'], record['member'])
+                values[keys.index(key), times.index(record['valid_time'])] = field.values()
+                templates.setdefault(key, field)
+                metrics.count('grib.fields_decoded')
+
+        slots = np.array(times, dtype='datetime64[s]')
+        period = np.timedelta64(int(period.total_seconds()), 's')
+        steps = np.diff(slots)
+        if len(steps) > 0 and slots[-1] < slots[0] + period <= slots[-1] + steps.max():
+            slots = np.append(slots, slots[0] + period)
+
+        targets = to_datetime64(target_times)
+        sources = slots[0] + (targets - slots[0]) % period
+        k, weight, valid = grib2.time_weights(slots, sources)
+        if not np.all(valid):
+            raise grib2.Grib2Error(f'{np.count_nonzero(~valid)} of {len(targets)} target times fall in the phase '
+                                   f'not covered by {self.grib_name}')
 
-        return dates
+        print(f'Writing {new_grib_name}')
+        with metrics.span('grib.rephase', grib=new_grib_name, times=len(targets)), open(new_grib_name, 'wb') as out:
+            for n, target in enumerate(targets.astype(object)):
+                k0 = k[n] % len(times)
+                k1 = (k[n] + 1) % len(times)
+                fields = values[:, k0] + np.float32(weight[n]) * (values[:, k1] - values[:, k0])
+                for key_idx, key in enumerate(keys):
+                    template = templates[key]
+                    ref_time = target - template.forecast_time
+                    out.write(grib2.make_message(template, fields[key_idx], ref_time=ref_time))
+                    metrics.count('grib.messages_written')
+
+    def get_dates(self):
+        # Read current time stamps from the GRIB file
+        try:
+            records = grib_index.load_inventory(self.grib_name)
+            return [r['ref_time'] for r in records if r['field'] == 0]
+        except grib2.Grib2Error:
+            # Not indexed, e.g. GRIB1
+            return grib2.read_ref_times(self.grib_name)
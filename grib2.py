@@ -0,0 +1,855 @@
+""" Minimal GRIB2 reader for the messages we actually use (HRRR/GFS winds)
+
+Supported:
+  - grid templates 3.0 (regular lat/lon) and 3.30 (Lambert conformal)
+  - data representation templates 5.0 (simple packing), 5.2 and 5.3 (complex packing with optional spatial
+    differencing)
+  - bitmap in section 6
+
+See https://www.nco.ncep.noaa.gov/pmb/docs/grib2/grib2_doc/
+"""
+import datetime
+import math
+import struct
+
+import numpy as np
+
+# (discipline, category, number) -> short name as wgrib2 prints it
+PARAMETERS = {
+    (0, 0, 0): 'TMP',
+    (0, 2, 0): 'WDIR',
+    (0, 2, 1): 'WIND',
+    (0, 2, 2): 'UGRD',
+    (0, 2, 3): 'VGRD',
+    (0, 2, 22): 'GUST',
+    (0, 3, 0): 'PRES',
+    (0, 3, 1): 'PRMSL',
+    (10, 1, 2): 'UOGRD',
+    (10, 1, 3): 'VOGRD',
+}
+
+# Type of fixed surface -> level format
+LEVELS = {
+    1: 'surface',
+    101: 'mean sea level',
+    103: '{} m above ground',
+    160: '{} m below sea level',
+}
+
+# Code table 4.4 unit of time range -> seconds
+TIME_UNITS = {
+    0: 60,
+    1: 3600,
+    2: 86400,
+    10: 3 * 3600,
+    11: 6 * 3600,
+    12: 12 * 3600,
+    13: 1,
+}
+
+# Perturbation number and number of forecasts in the ensemble take one octet each, all ones means missing
+MISSING_OCTET = 255
+MAX_ENSEMBLE_SIZE = MISSING_OCTET - 1
+
+EARTH_RADIUS = {
+    0: 6367470.0,
+    6: 6371229.0,
+    8: 6371200.0,
+}
+
+
+class Grib2Error(Exception):
+    pass
+
+
+def get_signed(buf, offset, size):
+    """ GRIB2 stores signed integers as sign and magnitude """
+    value = int.from_bytes(buf[offset:offset + size], 'big')
+    sign_bit = 1 << (size * 8 - 1)
+    if value & sign_bit:
+        return -(value & (sign_bit - 1))
+    return value
+
+
+def get_unsigned(buf, offset, size):
+    return int.from_bytes(buf[offset:offset + size], 'big')
+
+
+def put_signed(buf, offset, size, value):
+    magnitude = abs(int(value))
+    if value < 0:
+        magnitude |= 1 << (size * 8 - 1)
+    buf[offset:offset + size] = magnitude.to_bytes(size, 'big')
+
+
+def put_unsigned(buf, offset, size, value):
+    buf[offset:offset + size] = int(value).to_bytes(size, 'big')
+
+
+def section_bytes(buf, pos):
+    return bytes(buf[pos:pos + get_unsigned(buf, pos, 4)])
+
+
+def scan_messages(f):
+    """ Yields (offset, length, edition) of every message in the file """
+    offset = 0
+    while True:
+        f.seek(offset)
+        header = f.read(16)
+        if len(header) < 8:
+            return
+        if header[0:4] != b'GRIB':
+            # Skip padding some tools leave between messages
+            pos = header.find(b'GRIB', 1)
+            if pos < 0:
+                offset += max(len(header) - 3, 1)
+            else:
+                offset += pos
+            continue
+        edition = header[7]
+        if edition == 2:
+            length = get_unsigned(header, 8, 8)
+        elif edition == 1:
+            length = get_unsigned(header, 4, 3)
+        else:
+            raise Grib2Error(f'Unknown GRIB edition {edition} at offset {offset}')
+        yield offset, length, edition
+        offset += length
+
+
+def read_messages(grib_name):
+    """ Yields every GRIB2 message in the file """
+    with open(grib_name, 'rb') as f:
+        for offset, length, edition in scan_messages(f):
+            f.seek(offset)
+            yield Message(f.read(length), offset)
+
+
+def read_message(grib_name, offset, length):
+    with open(grib_name, 'rb') as f:
+        f.seek(offset)
+        return Message(f.read(length), offset)
+
+
+class Message:
+    def __init__(self, buf, offset=0):
+        self.buf = buf
+        self.offset = offset
+        if buf[0:4] != b'GRIB':
+            raise Grib2Error(f'No GRIB header at offset {offset}')
+        if buf[7] != 2:
+            raise Grib2Error(f'GRIB edition {buf[7]} is not supported')
+        self.discipline = buf[6]
+        self.length = get_unsigned(buf, 8, 8)
+        self.sections = []
+        pos = 16
+        while pos < self.length - 4:
+            sec_len = get_unsigned(buf, pos, 4)
+            sec_num = buf[pos + 4]
+            if sec_len < 5:
+                raise Grib2Error(f'Corrupted section {sec_num} at offset {offset + pos}')
+            self.sections.append((sec_num, pos, sec_len))
+            pos += sec_len
+        if buf[self.length - 4:self.length] != b'7777':
+            raise Grib2Error(f'Message at offset {offset} is truncated')
+
+    def section(self, num):
+        for sec_num, pos, sec_len in self.sections:
+            if sec_num == num:
+                return pos
+        return None
+
+    @property
+    def ref_time(self):
+        pos = self.section(1)
+        b = self.buf
+        return datetime.datetime(get_unsigned(b, pos + 12, 2), b[pos + 14], b[pos + 15], b[pos + 16], b[pos + 17],
+                                 b[pos + 18])
+
+    def fields(self):
+        """ A message can carry several fields repeating sections 2-7, 3-7 or 4-7 """
+        fields = []
+        current = {}
+        for sec_num, pos, sec_len in self.sections:
+            current[sec_num] = pos
+            if sec_num == 7:
+                fields.append(Field(self, current[3], current[4], current[5], current.get(6), pos))
+        return fields
+
+
+class Field:
+    def __init__(self, message, sec3, sec4, sec5, sec6, sec7):
+        self.message = message
+        self.sec3 = sec3
+        self.sec4 = sec4
+        self.sec5 = sec5
+        self.sec6 = sec6
+        self.sec7 = sec7
+        self._grid = None
+
+    @property
+    def pds_template(self):
+        return get_unsigned(self.message.buf, self.sec4 + 7, 2)
+
+    @property
+    def drs_template(self):
+        return get_unsigned(self.message.buf, self.sec5 + 9, 2)
+
+    @property
+    def var(self):
+        b = self.message.buf
+        key = (self.message.discipline, b[self.sec4 + 9], b[self.sec4 + 10])
+        return PARAMETERS.get(key, 'var discipline=%d category=%d number=%d' % key)
+
+    @property
+    def level(self):
+        b = self.message.buf
+        surface = b[self.sec4 + 22]
+        scale = get_signed(b, self.sec4 + 23, 1)
+        value = get_signed(b, self.sec4 + 24, 4)
+        if scale != 0 and scale != -127:
+            value = value / 10 ** scale
+            if value == int(value):
+                value = int(value)
+        fmt = LEVELS.get(surface, f'level type {surface} {{}}')
+        return fmt.format(value)
+
+    @property
+    def member(self):
+        """ Perturbation number of the ensemble member, 0 for deterministic products """
+        if self.pds_template in (1, 11):
+            return self.message.buf[self.sec4 + 35]
+        return 0
+
+    @property
+    def forecast_time(self):
+        b = self.message.buf
+        unit = b[self.sec4 + 17]
+        if unit not in TIME_UNITS:
+            raise Grib2Error(f'Unsupported time unit {unit}')
+        return datetime.timedelta(seconds=get_signed(b, self.sec4 + 18, 4) * TIME_UNITS[unit])
+
+    @property
+    def valid_time(self):
+        return self.message.ref_time + self.forecast_time
+
+    @property
+    def grid_definition(self):
+        """ Raw bytes of section 3 """
+        return section_bytes(self.message.buf, self.sec3)
+
+    @property
+    def product_definition(self):
+        """ Raw bytes of section 4 """
+        return section_bytes(self.message.buf, self.sec4)
+
+    @property
+    def scales(self):
+        """ (decimal, binary) scale factors of the packed values """
+        b = self.message.buf
+        return get_signed(b, self.sec5 + 17, 2), get_signed(b, self.sec5 + 15, 2)
+
+    @property
+    def grid(self):
+        if self._grid is None:
+            self._grid = make_grid(self.message.buf, self.sec3)
+        return self._grid
+
+    def values(self):
+        """ Decodes the field to float32 array of (nj, ni) shape, missing points are NaN """
+        grid = self.grid
+        b = self.message.buf
+        num_points = get_unsigned(b, self.sec3 + 6, 4)
+        num_values = get_unsigned(b, self.sec5 + 5, 4)
+        template = self.drs_template
+        data = memoryview(b)[self.sec7 + 5:self.sec7 + get_unsigned(b, self.sec7, 4)]
+        if template == 0:
+            values = unpack_simple(b, self.sec5, data, num_values)
+        elif template in (2, 3):
+            values = unpack_complex(b, self.sec5, data, num_values, template)
+        else:
+            raise Grib2Error(f'Data representation template 5.{template} is not supported')
+
+        bitmap = self.bitmap(num_points)
+        if bitmap is not None:
+            full = np.full(num_points, np.nan, dtype=np.float32)
+            full[bitmap] = values
+            values = full
+        elif len(values) != num_points:
+            raise Grib2Error(f'Expected {num_points} values got {len(values)}')
+        return grid.to_2d(values)
+
+    def bitmap(self, num_points):
+        if self.sec6 is None:
+            return None
+        b = self.message.buf
+        indicator = b[self.sec6 + 5]
+        if indicator == 255:
+            return None
+        if indicator != 0:
+            raise Grib2Error(f'Bitmap indicator {indicator} is not supported')
+        bits = np.unpackbits(np.frombuffer(b, dtype=np.uint8, count=get_unsigned(b, self.sec6, 4) - 6,
+                                           offset=self.sec6 + 6))
+        return bits[:num_points].astype(bool)
+
+
+def scale_values(b, sec5, x):
+    ref = struct.unpack('>f', b[sec5 + 11:sec5 + 15])[0]
+    bin_scale = get_signed(b, sec5 + 15, 2)
+    dec_scale = get_signed(b, sec5 + 17, 2)
+    return ((ref + x * 2.0 ** bin_scale) / 10.0 ** dec_scale).astype(np.float32)
+
+
+def unpack_fixed(bits, nbits, count, bit_offset=0):
+    """ Unpacks count unsigned integers of nbits each from the array of bits """
+    if nbits == 0:
+        return np.zeros(count, dtype=np.int64)
+    chunk = bits[bit_offset:bit_offset + nbits * count].reshape(count, nbits)
+    return chunk.dot(1 << np.arange(nbits - 1, -1, -1, dtype=np.int64))
+
+
+# Values unpacked at once, bounds the temporary arrays of the big fields
+UNPACK_CHUNK = 1 << 20
+
+
+def unpack_varying(data, starts, widths):
+    """ Unpacks unsigned integers of up to 57 bits from the bytes, starts are the bit positions of the integers and
+    widths their sizes in bits (array or a single width for all)
+
+    Every integer is read as the 64 bit big endian word starting at its first byte and shifted in place, so the cost
+    is a few operations per value whatever the widths are.
+    """
+    data = np.frombuffer(data, dtype=np.uint8)
+    words = np.lib.stride_tricks.sliding_window_view(np.concatenate((data, np.zeros(8, dtype=np.uint8))), 8)
+    widths = np.broadcast_to(np.asarray(widths, dtype=np.int64), np.shape(starts))
+    if len(widths) > 0 and widths.max() > 57:
+        raise Grib2Error(f'Packed values of {widths.max()} bits are not supported')
+    out = np.empty(len(starts), dtype=np.int64)
+    for n in range(0, len(starts), UNPACK_CHUNK):
+        s = starts[n:n + UNPACK_CHUNK]
+        w = widths[n:n + UNPACK_CHUNK].astype(np.uint64)
+        word = words[s >> 3].view('>u8').ravel()
+        shift = np.uint64(64) - (s & 7).astype(np.uint64) - w
+        mask = (np.uint64(1) << w) - np.uint64(1)
+        out[n:n + UNPACK_CHUNK] = ((word >> shift) & mask).astype(np.int64)
+    return out
+
+
+def unpack_simple(b, sec5, data, num_values):
+    nbits = b[sec5 + 19]
+    if nbits == 0:
+        # Constant field is the reference value as is, like ecCodes reads it
+        return np.full(num_values, struct.unpack('>f', b[sec5 + 11:sec5 + 15])[0], dtype=np.float32)
+    return scale_values(b, sec5, unpack_varying(data, np.arange(num_values, dtype=np.int64) * nbits, nbits))
+
+
+def unpack_complex(b, sec5, data, num_values, template):
+    nbits = b[sec5 + 19]
+    missing_mgmt = b[sec5 + 22]
+    num_groups = get_unsigned(b, sec5 + 31, 4)
+    width_ref = b[sec5 + 35]
+    width_bits = b[sec5 + 36]
+    length_ref = get_unsigned(b, sec5 + 37, 4)
+    length_inc = b[sec5 + 41]
+    last_length = get_unsigned(b, sec5 + 42, 4)
+    length_bits = b[sec5 + 46]
+
+    data = np.frombuffer(data, dtype=np.uint8)
+    pos = 0
+    order = 0
+    first_values = []
+    overall_min = 0
+    if template == 3:
+        order = b[sec5 + 47]
+        extra_octets = b[sec5 + 48]
+        raw = data.tobytes()
+        for i in range(order):
+            first_values.append(get_unsigned(raw, pos, extra_octets))
+            pos += extra_octets
+        if order > 0:
+            overall_min = get_signed(raw, pos, extra_octets)
+            pos += extra_octets
+
+    def padded(n):
+        return (n + 7) // 8 * 8
+
+    # Only the group descriptors are expanded to bits, the values are read from the bytes
+    header_bits = padded(nbits * num_groups) + padded(width_bits * num_groups) + padded(length_bits * num_groups)
+    bits = np.unpackbits(data[pos:pos + header_bits // 8])
+    bit_pos = 0
+
+    group_refs = unpack_fixed(bits, nbits, num_groups, bit_pos)
+    bit_pos += padded(nbits * num_groups)
+    group_widths = unpack_fixed(bits, width_bits, num_groups, bit_pos) + width_ref
+    bit_pos += padded(width_bits * num_groups)
+    group_lengths = unpack_fixed(bits, length_bits, num_groups, bit_pos) * length_inc + length_ref
+    bit_pos += padded(length_bits * num_groups)
+    if num_groups > 0:
+        group_lengths[-1] = last_length
+    if group_lengths.sum() != num_values:
+        raise Grib2Error(f'Complex packing groups cover {group_lengths.sum()} values instead of {num_values}')
+
+    widths = np.repeat(group_widths, group_lengths)
+    starts = np.concatenate(([0], np.cumsum(widths)[:-1]))
+    x = unpack_varying(data[pos + header_bits // 8:], starts, widths) + np.repeat(group_refs, group_lengths)
+
+    missing = None
+    if missing_mgmt in (1, 2):
+        # All ones is the primary missing value, all ones minus one is the secondary
+        refs = np.repeat(group_refs, group_lengths)
+        value_max = (1 << widths) - 1
+        ref_max = (1 << nbits) - 1
+        zero_width = widths == 0
+        missing = np.where(zero_width, refs == ref_max, x - refs == value_max)
+        if missing_mgmt == 2:
+            missing |= np.where(zero_width, refs == ref_max - 1, x - refs == value_max - 1)
+        x = x[~missing]
+
+    if order > 0:
+        x = x + overall_min
+        x[:order] = first_values
+        if order == 1:
+            x = np.cumsum(x)
+        elif order == 2:
+            diffs = x.copy()
+            diffs[1] = first_values[1] - first_values[0]
+            diffs[0] = first_values[0]
+            diffs[2:] = np.cumsum(x[2:]) + diffs[1]
+            x = np.cumsum(diffs)
+        else:
+            raise Grib2Error(f'Spatial differencing of order {order} is not supported')
+
+    values = scale_values(b, sec5, x)
+    if missing is not None:
+        full = np.full(len(missing), np.nan, dtype=np.float32)
+        full[~missing] = values
+        values = full
+    return values
+
+
+def make_grid(b, sec3):
+    template = get_unsigned(b, sec3 + 12, 2)
+    if template == 0:
+        return LatLonGrid(b, sec3)
+    if template == 30:
+        return LambertGrid(b, sec3)
+    raise Grib2Error(f'Grid definition template 3.{template} is not supported')
+
+
+def earth_radius(b, sec3):
+    shape = b[sec3 + 14]
+    if shape == 1:
+        return get_unsigned(b, sec3 + 16, 4) / 10.0 ** b[sec3 + 15]
+    return EARTH_RADIUS.get(shape, EARTH_RADIUS[6])
+
+
+def wrap_lon(lon):
+    return (np.asarray(lon, dtype=np.float64) + 180) % 360 - 180
+
+
+class Grid:
+    ni = 0
+    nj = 0
+    scan = 0
+    definition = b''
+    # Columns go around the globe, the last column is followed by the first one
+    wraps = False
+
+    def to_2d(self, values):
+        """ Reshapes values from the scanning order to (nj, ni) so that [j, i] is the i-th point of the j-th row """
+        if self.scan & 0x20:
+            values = values.reshape(self.ni, self.nj).T.copy()
+        else:
+            values = values.reshape(self.nj, self.ni)
+        if self.scan & 0x10:
+            values[1::2] = values[1::2, ::-1]
+        return values
+
+    def ij(self, lat, lon):
+        """ Returns fractional (j, i) indexes of the points """
+        raise NotImplementedError
+
+    def latlon(self, j, i):
+        """ Returns latitude and longitude of the (j, i) grid points """
+        raise NotImplementedError
+
+    def subgrid_definition(self, j0, j1, i0, i1):
+        """ Returns section 3 of the grid made of rows j0..j1 and columns i0..i1 in row major order """
+        raise NotImplementedError
+
+    def bbox_indexes(self, lat_range, lon_range):
+        """ Returns inclusive (j0, j1, i0, i1) index range of the smallest sub grid covering the lat/lon box """
+        n = 100
+        lats = np.linspace(lat_range[0], lat_range[1], n)
+        lons = np.linspace(lon_range[0], lon_range[1], n)
+        # The box edges are enough since the projections are continuous
+        edge_lats = np.concatenate((lats, lats, np.full(n, lat_range[0]), np.full(n, lat_range[1])))
+        edge_lons = np.concatenate((np.full(n, lon_range[0]), np.full(n, lon_range[1]), lons, lons))
+        j, i = self.ij(edge_lats, edge_lons)
+        j0 = max(int(np.floor(j.min())), 0)
+        j1 = min(int(np.ceil(j.max())), self.nj - 1)
+        i0 = max(int(np.floor(i.min())), 0)
+        i1 = min(int(np.ceil(i.max())), self.ni - 1)
+        if j0 > j1 or i0 > i1:
+            raise Grib2Error(f'Box {lat_range} {lon_range} is outside of the grid')
+        return j0, j1, i0, i1
+
+    def nearest(self, lat, lon):
+        """ Returns integer (j, i) indexes of the nearest grid points and a mask of points inside the grid """
+        j, i = self.ij(lat, lon)
+        j = np.rint(j).astype(np.int64)
+        i = np.rint(i).astype(np.int64)
+        if self.wraps:
+            i = i % self.ni
+        inside = (j >= 0) & (j < self.nj) & (i >= 0) & (i < self.ni)
+        return np.clip(j, 0, self.nj - 1), np.clip(i, 0, self.ni - 1), inside
+
+    def interpolate(self, values, lat, lon):
+        """ Bilinear interpolation of the (..., nj, ni) values at the points, NaN outside of the grid """
+        j, i = self.ij(lat, lon)
+        j0 = np.clip(np.floor(j).astype(np.int64), 0, max(self.nj - 2, 0))
+        j1 = np.minimum(j0 + 1, self.nj - 1)
+        if self.wraps:
+            # Points between the last column and 360 degrees interpolate with the first column
+            inside = (j >= 0) & (j <= self.nj - 1) & (i >= 0) & (i < self.ni)
+            i0 = np.clip(np.floor(i).astype(np.int64), 0, self.ni - 1)
+            i1 = (i0 + 1) % self.ni
+        else:
+            inside = (j >= 0) & (j <= self.nj - 1) & (i >= 0) & (i <= self.ni - 1)
+            i0 = np.clip(np.floor(i).astype(np.int64), 0, max(self.ni - 2, 0))
+            i1 = np.minimum(i0 + 1, self.ni - 1)
+        fj = np.clip(j - j0, 0, 1)
+        fi = np.clip(i - i0, 0, 1)
+        result = ((values[..., j0, i0] * (1 - fi) + values[..., j0, i1] * fi) * (1 - fj) +
+                  (values[..., j1, i0] * (1 - fi) + values[..., j1, i1] * fi) * fj)
+        return np.where(inside, result, np.nan)
+
+
+def time_weights(slots, times):
+    """ Returns (k, weight, valid) for linear interpolation of the times between sorted datetime64 slots
+
+    Every valid time lies between slots[k] and slots[k + 1], weight is the share of slot k + 1
+    """
+    k = np.searchsorted(slots, times, side='right') - 1
+    valid = (k >= 0) & ((k < len(slots) - 1) | (times == slots[-1]))
+    k0 = np.maximum(k, 0)
+    k1 = np.minimum(k + 1, len(slots) - 1)
+    span = (slots[k1] - slots[k0]).astype(np.float64)
+    elapsed = (times - slots[k0]).astype(np.float64)
+    weight = np.divide(elapsed, span, out=np.zeros(len(times)), where=span > 0)
+    return k, weight, valid
+
+
+class LatLonGrid(Grid):
+    def __init__(self, b, sec3):
+        self.definition = section_bytes(b, sec3)
+        self.ni = get_unsigned(b, sec3 + 30, 4)
+        self.nj = get_unsigned(b, sec3 + 34, 4)
+        basic_angle = get_unsigned(b, sec3 + 38, 4)
+        subdivisions = get_unsigned(b, sec3 + 42, 4)
+        unit = 1e-6 if basic_angle in (0, 0xffffffff) else basic_angle / subdivisions
+        self.unit = unit
+        self.la1 = get_signed(b, sec3 + 46, 4) * unit
+        self.lo1 = get_signed(b, sec3 + 50, 4) * unit
+        self.la2 = get_signed(b, sec3 + 55, 4) * unit
+        self.lo2 = get_signed(b, sec3 + 59, 4) * unit
+        self.di = get_unsigned(b, sec3 + 63, 4) * unit
+        self.dj = get_unsigned(b, sec3 + 67, 4) * unit
+        self.scan = b[sec3 + 71]
+        self.wraps = abs(self.ni * self.di - 360) < self.di / 2
+
+    def ij(self, lat, lon):
+        di = -self.di if self.scan & 0x80 else self.di
+        dj = self.dj if self.scan & 0x40 else -self.dj
+        i = wrap_lon(np.asarray(lon) - self.lo1)
+        if di > 0:
+            i = i % 360
+        else:
+            i = i % -360
+        return (np.asarray(lat, dtype=np.float64) - self.la1) / dj, i / di
+
+    def latlon(self, j, i):
+        di = -self.di if self.scan & 0x80 else self.di
+        dj = self.dj if self.scan & 0x40 else -self.dj
+        return self.la1 + np.asarray(j) * dj, wrap_lon(self.lo1 + np.asarray(i) * di)
+
+    def subgrid_definition(self, j0, j1, i0, i1):
+        d = bytearray(self.definition)
+        la1, lo1 = self.latlon(j0, i0)
+        la2, lo2 = self.latlon(j1, i1)
+        put_unsigned(d, 6, 4, (j1 - j0 + 1) * (i1 - i0 + 1))
+        put_unsigned(d, 30, 4, i1 - i0 + 1)
+        put_unsigned(d, 34, 4, j1 - j0 + 1)
+        put_signed(d, 46, 4, round(float(la1) / self.unit))
+        put_signed(d, 50, 4, round(float(lo1) % 360 / self.unit))
+        put_signed(d, 55, 4, round(float(la2) / self.unit))
+        put_signed(d, 59, 4, round(float(lo2) % 360 / self.unit))
+        d[71] = self.scan & ~0x30
+        return bytes(d)
+
+
+class LambertGrid(Grid):
+    def __init__(self, b, sec3):
+        self.definition = section_bytes(b, sec3)
+        self.radius = earth_radius(b, sec3)
+        self.ni = get_unsigned(b, sec3 + 30, 4)
+        self.nj = get_unsigned(b, sec3 + 34, 4)
+        self.la1 = get_signed(b, sec3 + 38, 4) * 1e-6
+        self.lo1 = get_unsigned(b, sec3 + 42, 4) * 1e-6
+        self.lad = get_signed(b, sec3 + 47, 4) * 1e-6
+        self.lov = get_unsigned(b, sec3 + 51, 4) * 1e-6
+        self.dx = get_unsigned(b, sec3 + 55, 4) * 1e-3
+        self.dy = get_unsigned(b, sec3 + 59, 4) * 1e-3
+        self.scan = b[sec3 + 64]
+        self.latin1 = get_signed(b, sec3 + 65, 4) * 1e-6
+        self.latin2 = get_signed(b, sec3 + 69, 4) * 1e-6
+
+        phi1 = math.radians(self.latin1)
+        phi2 = math.radians(self.latin2)
+        if abs(self.latin1 - self.latin2) < 1e-9:
+            self.n = math.sin(phi1)
+        else:
+            self.n = (math.log(math.cos(phi1) / math.cos(phi2)) /
+                      math.log(math.tan(math.pi / 4 + phi2 / 2) / math.tan(math.pi / 4 + phi1 / 2)))
+        self.f = math.cos(phi1) * math.tan(math.pi / 4 + phi1 / 2) ** self.n / self.n
+        self.rho0 = self.radius * self.f / math.tan(math.pi / 4 + math.radians(self.lad) / 2) ** self.n
+        self.x1, self.y1 = self.project(self.la1, self.lo1)
+
+    def project(self, lat, lon):
+        phi = np.radians(np.asarray(lat, dtype=np.float64))
+        rho = self.radius * self.f / np.tan(np.pi / 4 + phi / 2) ** self.n
+        theta = self.n * np.radians(wrap_lon(np.asarray(lon) - self.lov))
+        return rho * np.sin(theta), self.rho0 - rho * np.cos(theta)
+
+    def ij(self, lat, lon):
+        x, y = self.project(lat, lon)
+        dx = -self.dx if self.scan & 0x80 else self.dx
+        dy = self.dy if self.scan & 0x40 else -self.dy
+        return (y - self.y1) / dy, (x - self.x1) / dx
+
+    def latlon(self, j, i):
+        dx = -self.dx if self.scan & 0x80 else self.dx
+        dy = self.dy if self.scan & 0x40 else -self.dy
+        x = self.x1 + np.asarray(i) * dx
+        y = self.y1 + np.asarray(j) * dy
+        sign = 1 if self.n > 0 else -1
+        rho = sign * np.hypot(x, self.rho0 - y)
+        theta = np.arctan2(sign * x, sign * (self.rho0 - y))
+        lat = np.degrees(2 * np.arctan((self.radius * self.f / rho) ** (1 / self.n)) - np.pi / 2)
+        return lat, wrap_lon(self.lov + np.degrees(theta / self.n))
+
+    def subgrid_definition(self, j0, j1, i0, i1):
+        d = bytearray(self.definition)
+        la1, lo1 = self.latlon(j0, i0)
+        put_unsigned(d, 6, 4, (j1 - j0 + 1) * (i1 - i0 + 1))
+        put_unsigned(d, 30, 4, i1 - i0 + 1)
+        put_unsigned(d, 34, 4, j1 - j0 + 1)
+        put_signed(d, 38, 4, round(float(la1) * 1e6))
+        put_unsigned(d, 42, 4, round(float(lo1) % 360 * 1e6))
+        d[64] = self.scan & ~0x30
+        return bytes(d)
+
+
+def inventory(grib_name):
+    """ Returns list of records describing every field in the file """
+    records = []
+    for num, message in enumerate(read_messages(grib_name), start=1):
+        for field_idx, field in enumerate(message.fields()):
+            records.append({
+                'num': num,
+                'offset': message.offset,
+                'length': message.length,
+                'field': field_idx,
+                'var': field.var,
+                'level': field.level,
+                'member': field.member,
+                'ref_time': message.ref_time,
+                'valid_time': field.valid_time,
+                'packing': field.drs_template,
+                'grid': field.grid_definition.hex(),
+            })
+    return records
+
+
+def check_record(record):
+    """ Raises Grib2Error if the inventory record can't be decoded by this module """
+    if record['packing'] not in (0, 2, 3):
+        raise Grib2Error(f'Data representation template 5.{record["packing"]} is not supported')
+    make_grid(bytes.fromhex(record['grid']), 0)
+
+
+def set_ref_time(sec1, ref_time, pos=0):
+    """ Sets the reference time in the section 1 starting at pos of the bytearray """
+    put_unsigned(sec1, pos + 12, 2, ref_time.year)
+    sec1[pos + 14:pos + 19] = bytes([ref_time.month, ref_time.day, ref_time.hour, ref_time.minute, ref_time.second])
+
+
+# GRIB1 keeps the reference time in the product definition section that starts at octet 9
+GRIB1_PDS = 8
+
+
+def get_message_ref_time(buf):
+    """ Returns the reference time of the raw GRIB1 or GRIB2 message """
+    if buf[7] == 1:
+        pds = GRIB1_PDS
+        year = (buf[pds + 24] - 1) * 100 + buf[pds + 12]
+        return datetime.datetime(year, buf[pds + 13], buf[pds + 14], buf[pds + 15], buf[pds + 16])
+    # Section 1 always follows the 16 octets of section 0
+    pos = 16
+    return datetime.datetime(get_unsigned(buf, pos + 12, 2), buf[pos + 14], buf[pos + 15], buf[pos + 16],
+                             buf[pos + 17], buf[pos + 18])
+
+
+def set_message_ref_time(buf, ref_time):
+    """ Sets the reference time in the raw GRIB1 or GRIB2 message bytearray """
+    if buf[7] == 1:
+        pds = GRIB1_PDS
+        century = (ref_time.year - 1) // 100 + 1
+        buf[pds + 12:pds + 17] = bytes([ref_time.year - (century - 1) * 100, ref_time.month, ref_time.day,
+                                        ref_time.hour, ref_time.minute])
+        buf[pds + 24] = century
+    else:
+        set_ref_time(buf, ref_time, 16)
+
+
+def read_ref_times(grib_name):
+    """ Returns the reference time of every GRIB1 or GRIB2 message in the file """
+    times = []
+    with open(grib_name, 'rb') as f:
+        for offset, length, edition in scan_messages(f):
+            f.seek(offset)
+            times.append(get_message_ref_time(f.read(64)))
+    return times
+
+
+def encode_data(values, decimal_scale=2, binary_scale=0, max_bits=24):
+    """ Packs (nj, ni) values with the simple packing, returns bytes of sections 5, 6 and 7
+
+    NaN values are marked missing in the bitmap.
+    """
+    flat = np.asarray(values, dtype=np.float64).ravel()
+    valid = ~np.isnan(flat)
+    scaled = flat[valid] * 10.0 ** decimal_scale
+    ref = np.float32(0)
+    nbits = 0
+    x = np.zeros(0, dtype=np.int64)
+    if len(scaled) > 0:
+        ref = np.float32(scaled.min())
+        if ref > scaled.min():
+            ref = np.nextafter(ref, np.float32(-np.inf))
+        while True:
+            x = np.rint((scaled - ref) / 2.0 ** binary_scale).astype(np.int64)
+            nbits = int(x.max()).bit_length()
+            if nbits <= max_bits:
+                break
+            binary_scale += nbits - max_bits
+    if nbits == 0:
+        # Decoders disagree on scaling the reference of a constant field, so it is stored unscaled with D = E = 0
+        ref = np.float32(flat[valid].min()) if len(scaled) > 0 else np.float32(0)
+        binary_scale = 0
+        decimal_scale = 0
+
+    sec5 = bytearray(21)
+    put_unsigned(sec5, 0, 4, 21)
+    sec5[4] = 5
+    put_unsigned(sec5, 5, 4, len(scaled))
+    put_unsigned(sec5, 9, 2, 0)
+    sec5[11:15] = struct.pack('>f', ref)
+    put_signed(sec5, 15, 2, binary_scale)
+    put_signed(sec5, 17, 2, decimal_scale)
+    sec5[19] = nbits
+
+    if valid.all():
+        sec6 = bytes([0, 0, 0, 6, 6, 255])
+    else:
+        bitmap = np.packbits(valid).tobytes()
+        sec6 = (6 + len(bitmap)).to_bytes(4, 'big') + bytes([6, 0]) + bitmap
+
+    packed = b''
+    if nbits > 0:
+        bits = (x[:, None] >> np.arange(nbits - 1, -1, -1)) & 1
+        packed = np.packbits(bits.astype(np.uint8)).tobytes()
+    sec7 = (5 + len(packed)).to_bytes(4, 'big') + bytes([7]) + packed
+    return bytes(sec5) + sec6 + sec7
+
+
+def build_message(discipline, sections):
+    """ Joins the sections 1-7 to a GRIB2 message """
+    body = b''.join(sections)
+    length = 16 + len(body) + 4
+    return b'GRIB\0\0' + bytes([discipline, 2]) + length.to_bytes(8, 'big') + body + b'7777'
+
+
+def make_message(field, values=None, grid_definition=None, ref_time=None, product_definition=None):
+    """ Builds a single field message from the field, optionally replacing the values, grid, reference time and
+    product definition
+    """
+    message = field.message
+    sec1 = bytearray(section_bytes(message.buf, message.section(1)))
+    if ref_time is not None:
+        set_ref_time(sec1, ref_time)
+    sections = [sec1]
+    if message.section(2) is not None:
+        sections.append(section_bytes(message.buf, message.section(2)))
+    sections.append(field.grid_definition if grid_definition is None else grid_definition)
+    sections.append(field.product_definition if product_definition is None else product_definition)
+    if values is None:
+        b = message.buf
+        for pos in (field.sec5, field.sec6, field.sec7):
+            if pos is not None:
+                sections.append(section_bytes(b, pos))
+    else:
+        sections.append(encode_data(values, *field.scales))
+    return build_message(message.discipline, sections)
+
+
+def crop(field, lat_range, lon_range, ref_time=None):
+    """ Returns a message with the smallest sub grid of the field covering the lat/lon box """
+    j0, j1, i0, i1 = field.grid.bbox_indexes(lat_range, lon_range)
+    values = field.values()[j0:j1 + 1, i0:i1 + 1]
+    return make_message(field, values, field.grid.subgrid_definition(j0, j1, i0, i1), ref_time)
+
+
+def check_ensemble_size(ens_size):
+    """ Raises Grib2Error if the ensemble doesn't fit the one octet number of forecasts """
+    if ens_size > MAX_ENSEMBLE_SIZE:
+        raise Grib2Error(f'GRIB2 keeps the number of forecasts in the ensemble in one octet, {ens_size} members is '
+                         f'more than {MAX_ENSEMBLE_SIZE}, split them into several ensembles')
+
+
+def set_ensemble(message, ens_type, pert_num, ens_size):
+    """ Returns the message bytes with every product definition turned into the individual ensemble member one
+
+    Templates 4.0 and 4.8 become 4.1 and 4.11 by inserting the ensemble octets 35-37, templates 4.1 and 4.11 are
+    updated in place.
+    """
+    check_ensemble_size(max(pert_num, ens_size))
+    sections = []
+    for sec_num, pos, sec_len in message.sections:
+        sec = bytearray(message.buf[pos:pos + sec_len])
+        if sec_num == 4:
+            template = get_unsigned(sec, 7, 2)
+            if template in (0, 8):
+                sec[34:34] = bytes(3)
+                put_unsigned(sec, 0, 4, len(sec))
+                put_unsigned(sec, 7, 2, 1 if template == 0 else 11)
+            elif template not in (1, 11):
+                raise Grib2Error(f'Can not make ensemble member from product definition template 4.{template}')
+            sec[34:37] = bytes([ens_type, pert_num, ens_size])
+        sections.append(bytes(sec))
+    return build_message(message.discipline, sections)
+
+
+def derived_product_definition(field, var, template, extra):
+    """ Returns section 4 of the instantaneous field turned into template 4.2 (derived from all ensemble members) or
+    4.6 (percentile) of the meteorological parameter var, extra are the octets 35 on of the new template
+    """
+    sec4 = bytearray(field.product_definition)
+    if get_unsigned(sec4, 7, 2) not in (0, 1):
+        raise Grib2Error(f'Can not make derived product from product definition template 4.{get_unsigned(sec4, 7, 2)}')
+    category, number = [key[1:] for key, name in PARAMETERS.items() if name == var and key[0] == 0][0]
+    sec4 = sec4[:34] + bytes(extra)
+    put_unsigned(sec4, 0, 4, len(sec4))
+    put_unsigned(sec4, 7, 2, template)
+    sec4[9:11] = bytes([category, number])
+    return bytes(sec4)
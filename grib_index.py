@@ -0,0 +1,78 @@
+""" Sidecar index (<grib>.gribidx) keeping the inventory of a GRIB file
+
+The index is rebuilt when the size or modification time of the GRIB file changes, so opening a GRIB that was
+already indexed costs a stat() and reading a small JSON file instead of scanning all messages.
+"""
+import datetime
+import json
+import os
+
+import grib2
+
+INDEX_SUFFIX = '.gribidx'
+INDEX_VERSION = 2
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def index_name(grib_name):
+    return grib_name + INDEX_SUFFIX
+
+
+def load_inventory(grib_name):
+    """ Returns the inventory of the GRIB file, from the sidecar index if it is up to date """
+    st = os.stat(grib_name)
+    records = read_index(grib_name, st)
+    if records is None:
+        records = grib2.inventory(grib_name)
+        write_index(grib_name, st, records)
+    return records
+
+
+def read_index(grib_name, st):
+    try:
+        with open(index_name(grib_name), 'r') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if index.get('version') != INDEX_VERSION or index.get('size') != st.st_size \
+            or index.get('mtime_ns') != st.st_mtime_ns:
+        return None
+
+    records = []
+    for record in index['records']:
+        record = dict(record)
+        record['ref_time'] = datetime.datetime.strptime(record['ref_time'], TIME_FORMAT)
+        record['valid_time'] = datetime.datetime.strptime(record['valid_time'], TIME_FORMAT)
+        record['grid'] = index['grids'][record['grid']]
+        records.append(record)
+    return records
+
+
+def write_index(grib_name, st, records):
+    # Grid definitions are the same for most records, store each one once
+    grids = []
+    stored = []
+    for record in records:
+        record = dict(record)
+        if record['grid'] not in grids:
+            grids.append(record['grid'])
+        record['grid'] = grids.index(record['grid'])
+        record['ref_time'] = record['ref_time'].strftime(TIME_FORMAT)
+        record['valid_time'] = record['valid_time'].strftime(TIME_FORMAT)
+        stored.append(record)
+
+    index = {
+        'version': INDEX_VERSION,
+        'size': st.st_size,
+        'mtime_ns': st.st_mtime_ns,
+        'grids': grids,
+        'records': stored,
+    }
+    tmp_name = index_name(grib_name) + '.tmp'
+    try:
+        with open(tmp_name, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_name, index_name(grib_name))
+    except OSError as ex:
+        print(f'Can not write index for {grib_name}: {ex}')
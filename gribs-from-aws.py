@@ -2,18 +2,14 @@ import argparse
 import datetime
 import io
 import os.path
-import shutil
-import subprocess
 
-import boto3 as boto3
-import caffeine
-from botocore import UNSIGNED
-from botocore.config import Config
-from botocore.exceptions import ClientError
-from dateutil.relativedelta import relativedelta
+from botocore.exceptions import BotoCoreError, ClientError
 
-from grib import WGRIB_BIN
-from make_ens_grib import make_ensemble_grib
+import grib2
+import metrics
+from make_ens_grib import update_ensemble_grib
+from manifest import Manifest
+from s3_fetch import DirS3, Fetcher, RangeCache, is_missing
 
 BUCKET_NAME = 'noaa-hrrr-bdp-pds'
 
@@ -37,82 +33,150 @@ def parse_grib_index(grib_index):
     return records
 
 
-def get_one_day_small_grib(s3, start_date, hours_num, height_filter, type_filter, work_dir, offset_by_days):
-    small_grib_list = []
+def get_one_hour_small_grib(fetcher, run_time, height_filter, type_filter, bbox, offset_by_days,
+                            prefetch_only=False):
+    """ Returns bytes of the cropped and re-dated GRIB messages of one hour """
     fcst_hour = 0
-    for i in range(hours_num):
-        run_time = start_date + datetime.timedelta(hours=i)
-        grib_name = f'hrrr.{run_time.year:04d}{run_time.month:02d}{run_time.day:02d}/conus' \
-                    f'/hrrr.t{run_time.hour:02d}z.wrfsfcf{fcst_hour:02d}.grib2'
-        print(f'run_time = {run_time} grib_name = {grib_name}')
-
-        # Download GRIB index file
-        grib_idx_name = grib_name + '.idx'
-        try:
-            resp = s3.get_object(Bucket=BUCKET_NAME, Key=grib_idx_name)
-            grib_index = resp['Body'].read().decode("utf-8")
-
-            # Parse index file
-            records = parse_grib_index(grib_index)
-
-            # Download desired records of GRIB file
-            local_grib_name = os.path.expanduser(work_dir + os.sep + grib_name.replace('/', '_'))
-            with open(local_grib_name, 'wb') as gf:
-                for record in records:
-                    if record['height'] in height_filter and record['type'] in type_filter:
-                        start_byte = record["start"]
-                        stop_byte = record["end"]
-                        print(f'Downloading range {start_byte} {stop_byte} from s3://{BUCKET_NAME}/{grib_name} ...')
-                        resp = s3.get_object(Bucket=BUCKET_NAME, Key=grib_name, Range='bytes={}-{}'.format(start_byte,
-                                                                                                           stop_byte))
-                        res = resp['Body'].read()
-                        gf.write(res)
-                print(f'{local_grib_name} created.')
-
-                t = local_grib_name.split('.')
-                small_local_grib_name = '.'.join(t[0:-1]) + '.small.' + t[-1]
-
-                print(f'Extract small grib to {small_local_grib_name}')
-                args = [WGRIB_BIN, local_grib_name, '-set_date', f'{offset_by_days:+}dy',
-                        '-small_grib', '-72:-70', '41:42', small_local_grib_name]
-                subprocess.run(args)
-                small_grib_list.append(small_local_grib_name)
-
-                print(f'Removing {local_grib_name} ...')
-                os.unlink(local_grib_name)
-        except ClientError as ex:
-            if ex.response['Error']['Code'] == 'NoSuchKey':
-                print(f'GRIB {grib_name} not available on the server')
-            else:
-                raise
-
-    out_grib_name = work_dir + os.sep + f'hrrr-{start_date.year:04d}{start_date.month:02d}{start_date.day:02d}' \
-                                        f'{start_date.hour:02d}-{hours_num}hrs.small.grib2'
+    grib_name = f'hrrr.{run_time.year:04d}{run_time.month:02d}{run_time.day:02d}/conus' \
+                f'/hrrr.t{run_time.hour:02d}z.wrfsfcf{fcst_hour:02d}.grib2'
+    print(f'run_time = {run_time} grib_name = {grib_name}')
+
+    # Download GRIB index file
+    grib_idx_name = grib_name + '.idx'
+    try:
+        grib_index = fetcher.get(grib_idx_name).decode("utf-8")
+    except (ClientError, BotoCoreError, OSError) as ex:
+        # Retries are done by the fetcher, give up on this hour only
+        if is_missing(ex):
+            print(f'GRIB {grib_name} not available on the server')
+        else:
+            print(f'GRIB index {grib_idx_name} failed to download: {ex}')
+        return None
+
+    # Parse index file
+    records = parse_grib_index(grib_index)
+
+    # Download desired records of GRIB file
+    ranges = [(record['start'], record.get('end')) for record in records
+              if record['height'] in height_filter and record['type'] in type_filter]
+    try:
+        records_data = fetcher.get_ranges(grib_name, ranges)
+    except (ClientError, BotoCoreError, OSError) as ex:
+        print(f'GRIB {grib_name} failed to download: {ex}')
+        return None
+    if prefetch_only:
+        return None
+
+    # Crop every record to the box and shift its date, all in memory
+    lat_range, lon_range = bbox
+    small_grib = []
+    for data in records_data:
+        with metrics.span('grib.crop', grib=grib_name):
+            message = grib2.Message(data)
+            ref_time = message.ref_time + datetime.timedelta(days=offset_by_days)
+            for field in message.fields():
+                small_grib.append(grib2.crop(field, lat_range, lon_range, ref_time))
+                metrics.count('grib.fields_cropped')
+    return b''.join(small_grib)
+
+
+def small_grib_name(start_date, hours_num):
+    return f'hrrr-{start_date.year:04d}{start_date.month:02d}{start_date.day:02d}' \
+           f'{start_date.hour:02d}-{hours_num}hrs.small.grib2'
+
+
+def combine_small_gribs(work_dir, start_date, hours_num, small_grib_list):
+    """ Writes the small GRIBs to one file, returns offsets of the small GRIBs in it """
+    out_grib_name = work_dir + os.sep + small_grib_name(start_date, hours_num)
     print(f'Combine small gribs to one {out_grib_name} ...')
-    with open(out_grib_name, 'wb') as out_grib:
+    offsets = []
+    with metrics.span('combine', grib=out_grib_name), open(out_grib_name, 'wb') as out_grib:
         for small_grib in small_grib_list:
-            in_grib = open(small_grib, 'rb')
-            shutil.copyfileobj(in_grib, out_grib)
-            in_grib.close()
-            print(f'Removing {small_grib} ...')
-            os.unlink(small_grib)
+            offsets.append(out_grib.tell())
+            out_grib.write(small_grib)
 
         print(f'{out_grib_name} created.')
+    return offsets
 
 
-def download_gribs(work_dir, start_date, race_date, hours_num, historical, days_span, years_span):
-    s3 = boto3.client('s3', config=Config(signature_version=UNSIGNED))
-    height_filter = ['10 m above ground']
-    type_filter = ['UGRD', 'VGRD']
-    if historical:
-        for year in range(years_span + 1):
-            for day in range(-days_span, days_span + 1, 1):
-                grib_date = start_date - relativedelta(years=year) + datetime.timedelta(days=day)
-                offset_by_days = (race_date - grib_date).days
-                print(f'grib_date = {grib_date} offset by {offset_by_days}dy')
-                get_one_day_small_grib(s3, grib_date, hours_num, height_filter, type_filter, work_dir, offset_by_days)
-    else:
-        print('Not supported yet')
+def parse_range(range_str):
+    """ Parses wgrib2 style range like -72:-70 """
+    t = range_str.split(':')
+    return float(t[0]), float(t[1])
+
+
+def make_s3_client(workers, s3_dir=None):
+    if s3_dir is not None:
+        return DirS3(s3_dir)
+    import boto3
+    from botocore import UNSIGNED
+    from botocore.config import Config
+    # One client shared by all threads, with a connection per worker
+    return boto3.client('s3', config=Config(signature_version=UNSIGNED, max_pool_connections=workers))
+
+
+def download_gribs(work_dir, start_date, race_date, hours_num, historical, days_span, years_span, bbox, workers=8,
+                   s3_dir=None, cache=None, prefetch_only=False, manifest=None):
+    """ Writes a small GRIB per day, returns their names
+
+    With the manifest only the hours missing in the work directory are downloaded and the day GRIBs already holding
+    all their hours are left alone.
+    """
+    from dateutil.relativedelta import relativedelta
+    fetcher = Fetcher(make_s3_client(workers, s3_dir), BUCKET_NAME, workers, cache=cache)
+    try:
+        height_filter = ['10 m above ground']
+        type_filter = ['UGRD', 'VGRD']
+        records = [f'{t}:{h}' for t in type_filter for h in height_filter]
+        day_files = []
+        if historical:
+            days = []
+            for year in range(years_span + 1):
+                for day in range(-days_span, days_span + 1, 1):
+                    grib_date = start_date - relativedelta(years=year) + datetime.timedelta(days=day)
+                    offset_by_days = (race_date - grib_date).days
+                    hours = [grib_date + datetime.timedelta(hours=i) for i in range(hours_num)]
+                    name = small_grib_name(grib_date, hours_num)
+                    done = {}
+                    if manifest is not None and not prefetch_only:
+                        done = {h: manifest.get_hour(h, records, bbox, offset_by_days, name) for h in hours}
+                    missing = [h for h in hours if done.get(h) is None]
+                    print(f'grib_date = {grib_date} offset by {offset_by_days}dy, {len(missing)} hours to download')
+                    futures = {h: fetcher.submit(get_one_hour_small_grib, fetcher, h, height_filter, type_filter, bbox,
+                                                 offset_by_days, prefetch_only) for h in missing}
+                    days.append((grib_date, name, offset_by_days, hours, done, futures))
+
+            # All hours of all days are downloaded concurrently, the days are combined in order
+            for grib_date, name, offset_by_days, hours, done, futures in days:
+                small_grib_list = {h: f.result() for h, f in futures.items()}
+                if prefetch_only:
+                    continue
+                # Hours not on the server yet are tried again next time, the day GRIB is kept if nothing new came
+                kept = [h for h in hours if done.get(h) is not None]
+                if manifest is not None and all(g is None for g in small_grib_list.values()) \
+                        and all(done[h]['file'] == name for h in kept):
+                    if len(kept) > 0:
+                        print(f'{name} is up to date')
+                        day_files.append(os.path.join(work_dir, name))
+                    continue
+
+                for h in hours:
+                    if done.get(h) is not None:
+                        small_grib_list[h] = manifest.read_hour(done[h])
+                available = [h for h in hours if small_grib_list[h] is not None]
+                offsets = combine_small_gribs(work_dir, grib_date, hours_num, [small_grib_list[h] for h in available])
+                if len(available) > 0:
+                    day_files.append(os.path.join(work_dir, name))
+                if manifest is not None:
+                    manifest.set_file(name, [(h, records, bbox, offset_by_days, offset, len(small_grib_list[h]))
+                                             for h, offset in zip(available, offsets)])
+                    manifest.save()
+        else:
+            print('Not supported yet')
+    finally:
+        # Hours still queued after an error are not downloaded
+        fetcher.shutdown(cancel_futures=True)
+    return day_files
 
 
 def gribs_from_aws(args):
@@ -129,15 +193,28 @@ def gribs_from_aws(args):
     race_date = race_date + datetime.timedelta(hours=args.start_hour)
     print(f'Race date {race_date}')
 
-    download_gribs(args.work_dir, start_date, race_date, args.hours_num, args.historical, args.days_span,
-                   args.years_span)
+    cache = None
+    if args.cache_size_gb > 0:
+        cache = RangeCache(os.path.expanduser(args.cache_dir), args.cache_size_gb * 1e9)
 
-    # Join multiple  GRIBs into one ensemble grib
-    make_ensemble_grib(args.work_dir, args.out_grib_name)
+    os.makedirs(args.work_dir, exist_ok=True)
+    manifest = Manifest(args.work_dir, args.rebuild)
 
+    bbox = (parse_range(args.lat_range), parse_range(args.lon_range))
+    day_files = download_gribs(args.work_dir, start_date, race_date, args.hours_num, args.historical, args.days_span,
+                               args.years_span, bbox, args.workers, args.s3_dir, cache, args.prefetch_only, manifest)
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+    if args.prefetch_only:
+        print(f'Records are stored in {args.cache_dir}')
+        return
+
+    # Join multiple  GRIBs into one ensemble grib, only the new or changed days are processed
+    with metrics.span('ensemble'):
+        manifest.ensemble = update_ensemble_grib(day_files, args.out_grib_name, manifest.ensemble)
+    manifest.save()
+
+
+def add_arguments(parser):
     parser.add_argument("--work-dir", help="Directory to keep GRIB files", default='./data')
     parser.add_argument("--out-grib-name", help="Name of the output ensemble GRIB", required=False,
                         default='./data/output.grib2')
@@ -150,6 +227,33 @@ if __name__ == '__main__':
     parser.add_argument("--years-span", help="For historical data get that many years before", required=False,
                         type=int, default=0)
     parser.add_argument("--historical", help="Get historical winds using F0 only", required=False, action='store_true')
+    parser.add_argument("--lon-range", help="Longitudes of the area to keep, use --lon-range=-72:-70 form",
+                        required=False, default='-72:-70')
+    parser.add_argument("--lat-range", help="Latitudes of the area to keep", required=False, default='41:42')
+    parser.add_argument("--workers", help="Number of concurrent downloads", required=False, type=int, default=8)
+    parser.add_argument("--s3-dir", help="Read the bucket from this local directory instead of S3 (for testing)",
+                        required=False)
+    parser.add_argument("--cache-dir", help="Directory to keep downloaded GRIB records", default='./data/cache')
+    parser.add_argument("--cache-size-gb", help="Maximum size of the download cache, 0 disables the cache",
+                        required=False, type=float, default=10)
+    parser.add_argument("--prefetch-only", help="Only download the records to the cache", required=False,
+                        action='store_true')
+    parser.add_argument("--rebuild", help="Ignore the manifest of the work directory and build everything again",
+                        required=False, action='store_true')
+
+
+def main(args):
+    # Keep the Mac awake during the long downloads
+    import caffeine
     caffeine.on(display=False)
-    gribs_from_aws(parser.parse_args())
-    caffeine.off()
+    try:
+        gribs_from_aws(args)
+    finally:
+        caffeine.off()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+    add_arguments(parser)
+    metrics.add_arguments(parser)
+    metrics.run(parser.parse_args(), main)
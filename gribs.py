@@ -0,0 +1,59 @@
+""" Single entry point of the scripts
+
+    python3 gribs.py download @args/spin-cup-highway.txt
+    python3 gribs.py verify @args/verify.txt --metrics
+
+Only the module of the given command is imported, so the quick commands don't pay for boto3, moviepy or gpxpy.
+"""
+import argparse
+import importlib
+import sys
+
+import metrics
+
+# command -> (module, help, whether unknown options are ignored because the argument files are shared)
+COMMANDS = {
+    'download': ('gribs-from-aws', 'Download historical HRRR hours and build the highway ensemble GRIB', False),
+    'ensemble': ('make_ens_grib', 'Merge highway GRIBs to one ensemble GRIB', False),
+    'ens-stats': ('ens_stats', 'Mean, speed percentiles and direction spread GRIB of the ensemble', False),
+    'const-wind': ('make_const_wind_grib', 'Write GRIBs with constant wind', True),
+    'adjust-currents': ('adjust_currents_grib', 'Move the currents GRIB to the race date', True),
+    'verify': ('verify_model', 'Compare GRIBs with the boat instruments data', False),
+    'stats': ('wind_stats', 'Wind statistics of the highway GRIBs along the route', False),
+    'timeline': ('time_line_img', 'Add the time line to the tide clip', False),
+    'store': ('field_store', 'Decode GRIB winds to the memory mapped store', False),
+    'corridor': ('tile_index', 'Extract the wind along the route', False),
+}
+
+
+def find_command(argv):
+    for arg in argv:
+        if arg in COMMANDS:
+            return arg
+    return None
+
+
+def make_parser(command=None):
+    """ Returns the parser with the options of the command only, the other commands are listed by name """
+    parser = argparse.ArgumentParser(prog='gribs', fromfile_prefix_chars='@')
+    subparsers = parser.add_subparsers(dest='command', metavar='command', required=True)
+    for name, (module_name, help_text, ignore_unknown) in COMMANDS.items():
+        subparser = subparsers.add_parser(name, help=help_text, description=help_text, fromfile_prefix_chars='@')
+        if name == command:
+            importlib.import_module(module_name).add_arguments(subparser)
+            metrics.add_arguments(subparser)
+    return parser
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    parser = make_parser(find_command(argv))
+    args, unknown = parser.parse_known_args(argv)
+    module_name, help_text, ignore_unknown = COMMANDS[args.command]
+    if unknown and not ignore_unknown:
+        parser.error(f'unrecognized arguments: {" ".join(unknown)}')
+    return metrics.run(args, importlib.import_module(module_name).main)
+
+
+if __name__ == '__main__':
+    main()
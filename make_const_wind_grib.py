@@ -1,21 +1,63 @@
 import argparse
+import concurrent.futures
+import os
 
+import metrics
 from grib import Grib
 
+# Template shared by the worker processes
+template = None
+
+
+def init_worker(grib):
+    global template
+    template = grib
+
+
+def make_scenario(tws, twd, output_grib, start_date_utc):
+    template.force_wind(tws, twd, output_grib, start_date_utc)
+    return output_grib
+
 
 def make_constant_wind_grib(args):
     grib = Grib(args.template_grib)
-    grib.force_wind(float(args.tws), float(args.twd), args.output_grib, args.start_date_utc)
+    tws_list = [float(tws) for tws in args.tws.split(',')]
+    twd_list = [float(twd) for twd in args.twd.split(',')]
+    if len(tws_list) == 1 and len(twd_list) == 1:
+        grib.force_wind(tws_list[0], twd_list[0], args.output_grib, args.start_date_utc)
+        return
 
+    # Batch mode: the whole TWS x TWD matrix, the template is parsed once and handed to every worker
+    grib.read_messages()
+    scenarios = [(tws, twd, args.output_grib.format(tws=f'{tws:g}', twd=f'{twd:g}'))
+                 for tws in tws_list for twd in twd_list]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                                                initargs=(grib,)) as executor:
+        futures = [executor.submit(make_scenario, tws, twd, output_grib, args.start_date_utc)
+                   for tws, twd, output_grib in scenarios]
+        for future in futures:
+            print(f'{future.result()} created')
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+
+def add_arguments(parser):
     parser.add_argument("--template-grib", help="Template GRIB file", required=True)
-    parser.add_argument("--output-grib", help="Output GRIB file", required=True)
+    parser.add_argument("--output-grib", help="Output GRIB file, in batch mode a pattern with {tws} and {twd} like "
+                                              "data/wind-{tws}kts-{twd}deg.grib2", required=True)
     parser.add_argument("--start-date-utc", help="GRIB UTC start date YYYY-MM-DD", required=True)
-    parser.add_argument("--tws", help="Wind speed [kts]", required=True)
-    parser.add_argument("--twd", help="Wind direction [degrees]", required=True)
+    parser.add_argument("--tws", help="Wind speed [kts], comma separated list for batch mode", required=True)
+    parser.add_argument("--twd", help="Wind direction [degrees], comma separated list for batch mode", required=True)
+    parser.add_argument("--workers", help="Number of processes in batch mode", type=int, default=os.cpu_count())
     parser.add_argument("--work-dir", help="Directory to keep clips", default='./data')
-    params, unknown = parser.parse_known_args()
-    make_constant_wind_grib(params)
 
+
+def main(args):
+    if (',' in args.tws or ',' in args.twd) and ('{tws}' not in args.output_grib or '{twd}' not in args.output_grib):
+        raise SystemExit('--output-grib must contain {tws} and {twd} in batch mode')
+    make_constant_wind_grib(args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+    add_arguments(parser)
+    metrics.add_arguments(parser)
+    metrics.run(parser.parse_known_args()[0], main)
@@ -1,48 +1,136 @@
 """ This script merges multiple highway GRIB files to the single one """
 import argparse
+import collections
+import concurrent.futures
 import glob
 import os
-import subprocess
-import tempfile
 
-from grib import WGRIB_BIN
+import grib2
+import metrics
 
 # See https://www.nco.ncep.noaa.gov/pmb/docs/grib2/grib2_doc/grib2_table4-0.shtml
 ENS_MEM_TYPE = 3
 
 
-def make_ensemble_grib(highway_dir, ens_grib):
-    with tempfile.TemporaryDirectory() as work_dir:
-        print('created temporary directory', work_dir)
-        grib_files = glob.glob(highway_dir + '/*.grib2')
-        num_of_forecasts = len(grib_files)
-        ens_gribs = []
-        for num, grib_file in enumerate(sorted(grib_files)):
-            pert_num = num + 1
-            out_grib_name = os.path.join(work_dir, f'ens_{pert_num:02d}.grib2')
-            cmd = [WGRIB_BIN, '-set_ens_num', f'{ENS_MEM_TYPE}', f'{pert_num}', f'{num_of_forecasts}', f'{grib_file}',
-                   '-grib', out_grib_name]
-            print(f'Running {" ".join(cmd)}')
-            subprocess.run(cmd)
-            ens_gribs += [out_grib_name]
-
-        with open(ens_grib, 'wb') as ens_file:
-            for grib in ens_gribs:
-                if os.path.isfile(grib):
-                    print(f' Appending {grib} to {ens_grib}')
-                    with open(grib, 'rb') as f:
-                        ens_file.write(f.read())
-                    os.unlink(grib)
-                else:
-                    print(f' {grib} does not exist')
+def make_member(grib_file, pert_num, num_of_forecasts):
+    """ Returns the GRIB file as the ensemble member, the messages are patched one by one """
+    with metrics.span('ensemble.member', grib=grib_file):
+        return b''.join(grib2.set_ensemble(message, ENS_MEM_TYPE, pert_num, num_of_forecasts)
+                        for message in grib2.read_messages(grib_file))
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+def make_ensemble_grib(highway_dir, ens_grib, workers=1):
+    grib_files = sorted(glob.glob(highway_dir + '/*.grib2'))
+    num_of_forecasts = len(grib_files)
+    grib2.check_ensemble_size(num_of_forecasts)
+    with open(ens_grib, 'wb') as ens_file:
+        if workers <= 1:
+            for num, grib_file in enumerate(grib_files):
+                print(f' Appending {grib_file} to {ens_grib}')
+                with metrics.span('ensemble.member', grib=grib_file):
+                    for message in grib2.read_messages(grib_file):
+                        ens_file.write(grib2.set_ensemble(message, ENS_MEM_TYPE, num + 1, num_of_forecasts))
+                metrics.count('ensemble.members')
+            return
+
+        # Members are built in parallel and written in order, only a few of them are kept in memory at a time
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = collections.deque()
+            for num, grib_file in enumerate(grib_files):
+                pending.append((grib_file, executor.submit(make_member, grib_file, num + 1, num_of_forecasts)))
+                if len(pending) >= 2 * workers:
+                    write_member(ens_file, ens_grib, *pending.popleft())
+            while pending:
+                write_member(ens_file, ens_grib, *pending.popleft())
+
+
+def file_stat(name):
+    try:
+        st = os.stat(name)
+    except FileNotFoundError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def patch_ensemble_size(ens_file, end, num_of_forecasts):
+    """ Sets the number of forecasts in the ensemble (octet 37 of templates 4.1 and 4.11) of the messages before end """
+    for offset, length, edition in grib2.scan_messages(ens_file):
+        if offset >= end:
+            break
+        ens_file.seek(offset)
+        message = grib2.Message(ens_file.read(length), offset)
+        for sec_num, pos, sec_len in message.sections:
+            if sec_num == 4:
+                ens_file.seek(offset + pos + 36)
+                ens_file.write(bytes([num_of_forecasts]))
+
+
+def update_ensemble_grib(grib_files, ens_grib, state=None):
+    """ Brings the ensemble GRIB in line with grib_files, returns the state to pass to the next call
+
+    Members already in the ensemble keep their place and bytes, new members are appended and a changed or removed
+    member rewrites the ensemble from its place on. The kept members only get their ensemble size patched.
+    """
+    members = []
+    if state is not None and file_stat(ens_grib) == (state['size'], state['mtime_ns']):
+        members = state['members']
+    known = {m['grib'] for m in members}
+    wanted = set(grib_files)
+    order = [m['grib'] for m in members if m['grib'] in wanted] + [g for g in grib_files if g not in known]
+    num_of_forecasts = len(order)
+    grib2.check_ensemble_size(num_of_forecasts)
+
+    keep = 0
+    while keep < min(len(members), num_of_forecasts) and members[keep]['grib'] == order[keep] \
+            and file_stat(order[keep]) == (members[keep]['grib_size'], members[keep]['grib_mtime_ns']):
+        keep += 1
+    if keep == len(members) == num_of_forecasts:
+        print(f'{ens_grib} is up to date')
+        return state
+
+    end = members[keep - 1]['offset'] + members[keep - 1]['length'] if keep > 0 else 0
+    print(f'Keeping {keep} members of {ens_grib}, adding {num_of_forecasts - keep}')
+    with metrics.span('ensemble.update', grib=ens_grib), open(ens_grib, 'r+b' if keep > 0 else 'wb') as ens_file:
+        ens_file.truncate(end)
+        if keep > 0 and len(members) != num_of_forecasts:
+            patch_ensemble_size(ens_file, end, num_of_forecasts)
+        members = members[:keep]
+        ens_file.seek(end)
+        for num in range(keep, num_of_forecasts):
+            print(f' Appending {order[num]} to {ens_grib}')
+            data = make_member(order[num], num + 1, num_of_forecasts)
+            size, mtime_ns = file_stat(order[num])
+            members.append({'grib': order[num], 'grib_size': size, 'grib_mtime_ns': mtime_ns,
+                            'offset': ens_file.tell(), 'length': len(data)})
+            ens_file.write(data)
+            metrics.count('ensemble.members')
+
+    size, mtime_ns = file_stat(ens_grib)
+    return {'size': size, 'mtime_ns': mtime_ns, 'members': members}
+
+
+def write_member(ens_file, ens_grib, grib_file, future):
+    print(f' Appending {grib_file} to {ens_grib}')
+    data = future.result()
+    with metrics.span('ensemble.write', grib=grib_file):
+        ens_file.write(data)
+    metrics.count('ensemble.members')
+
+
+def add_arguments(parser):
     parser.add_argument("--work-dir", help="Directory to keep GRIB files", default='./data')
     parser.add_argument("--highway-dir", help="Directory containing highway GRIBs", required=True)
     parser.add_argument("--ens-grib", help="Ensemble grib", required=True)
-    args = parser.parse_args()
-    make_ensemble_grib(args.highway_dir, args.ens_grib)
+    parser.add_argument("--workers", help="Number of members to build in parallel", required=False, type=int,
+                        default=1)
+
+
+def main(args):
+    make_ensemble_grib(args.highway_dir, args.ens_grib, args.workers)
 
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+    add_arguments(parser)
+    metrics.add_arguments(parser)
+    metrics.run(parser.parse_args(), main)
@@ -0,0 +1,87 @@
+""" Manifest (<work dir>/manifest.json) of the highway GRIBs already built in the work directory
+
+For every downloaded HRRR hour it keeps the small GRIBs holding it, the byte range of the hour in each of them, the
+variables/levels, the box and the day offset it was made with. A file counts only while its size and modification
+time match the manifest, so a file edited or deleted by hand is downloaded again.
+"""
+import json
+import os
+
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+HOUR_FORMAT = '%Y%m%d%H'
+
+
+class Manifest:
+    def __init__(self, work_dir, rebuild=False):
+        self.work_dir = work_dir
+        self.path = os.path.join(work_dir, MANIFEST_NAME)
+        # hour -> file name -> entry
+        self.hours = {}
+        self.files = {}
+        self.ensemble = None
+        if rebuild:
+            return
+        try:
+            with open(self.path, 'r') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('version') != MANIFEST_VERSION:
+            return
+        self.hours = data['hours']
+        self.files = data['files']
+        self.ensemble = data.get('ensemble')
+
+    def save(self):
+        data = {
+            'version': MANIFEST_VERSION,
+            'hours': self.hours,
+            'files': self.files,
+            'ensemble': self.ensemble,
+        }
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, indent=1)
+        os.replace(tmp_path, self.path)
+
+    def file_valid(self, name):
+        """ True if the file in the work directory is the one recorded in the manifest """
+        entry = self.files.get(name)
+        try:
+            st = os.stat(os.path.join(self.work_dir, name))
+        except OSError:
+            return False
+        return entry is not None and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns
+
+    def get_hour(self, run_time, records, bbox, offset_by_days, name=None):
+        """ Returns the entry of the hour built with the records, box and offset, preferably the one in the file name """
+        entries = self.hours.get(run_time.strftime(HOUR_FORMAT), {})
+        for file_name in sorted(entries, key=lambda n: n != name):
+            entry = entries[file_name]
+            if self.file_valid(file_name) and set(records) <= set(entry['records']) \
+                    and entry['bbox'] == [list(r) for r in bbox] and entry['offset_by_days'] == offset_by_days:
+                return dict(entry, file=file_name)
+        return None
+
+    def read_hour(self, entry):
+        with open(os.path.join(self.work_dir, entry['file']), 'rb') as f:
+            f.seek(entry['offset'])
+            return f.read(entry['length'])
+
+    def set_file(self, name, hours):
+        """ Records the new content of the file, hours is list of (run_time, records, bbox, offset_by_days, offset,
+        length) of the hours in it
+        """
+        for entries in self.hours.values():
+            entries.pop(name, None)
+        for run_time, records, bbox, offset_by_days, offset, length in hours:
+            self.hours.setdefault(run_time.strftime(HOUR_FORMAT), {})[name] = {
+                'records': sorted(records),
+                'bbox': [list(r) for r in bbox],
+                'offset_by_days': offset_by_days,
+                'offset': offset,
+                'length': length,
+            }
+        st = os.stat(os.path.join(self.work_dir, name))
+        self.files[name] = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
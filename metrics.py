@@ -0,0 +1,140 @@
+""" Timing spans and counters shared by the scripts
+
+    with metrics.span('s3.get', key=key):
+        data = download()
+    metrics.count('s3.bytes', len(data))
+
+Spans and counters are aggregated in memory for the summary table printed at the end of the run, with a trace file
+every finished span is also written as a JSON line. Only the calling process is recorded, work done in the worker
+processes of the process pools shows up as the span around the pool.
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+
+lock = threading.Lock()
+spans = {}
+counters = {}
+trace = None
+# Forked pool workers inherit the module state, they must not write to the trace file of the parent
+owner_pid = os.getpid()
+
+
+def configure(trace_file=None):
+    """ Resets the collected metrics, with trace_file every span is written to it as a JSON line """
+    global trace, owner_pid
+    with lock:
+        owner_pid = os.getpid()
+        spans.clear()
+        counters.clear()
+        if trace is not None:
+            trace.close()
+        trace = open(trace_file, 'w') if trace_file is not None else None
+
+
+def count(name, value=1):
+    if os.getpid() != owner_pid:
+        return
+    with lock:
+        counters[name] = counters.get(name, 0) + value
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """ Measures the wall time of the block, attrs go to the trace only """
+    start = time.time()
+    start_perf = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start_perf
+        if os.getpid() == owner_pid:
+            record_span(name, start, duration, attrs)
+
+
+def record_span(name, start, duration, attrs):
+    with lock:
+        total = spans.setdefault(name, [0, 0.0, 0.0])
+        total[0] += 1
+        total[1] += duration
+        total[2] = max(total[2], duration)
+        if trace is not None:
+            record = {'span': name, 'start': round(start, 6), 'duration': round(duration, 6), 'pid': os.getpid(),
+                      'thread': threading.current_thread().name, **attrs}
+            trace.write(json.dumps(record, default=str) + '\n')
+
+
+def summary():
+    """ Prints the table of spans and counters """
+    with lock:
+        if spans:
+            print(f'{"span":<28}{"count":>8}{"total s":>10}{"mean ms":>10}{"max ms":>10}')
+            for name, (num, total, longest) in sorted(spans.items(), key=lambda s: -s[1][1]):
+                print(f'{name:<28}{num:>8}{total:>10.2f}{total / num * 1000:>10.1f}{longest * 1000:>10.1f}')
+        if counters:
+            print(f'{"counter":<28}{"value":>18}')
+            for name, value in sorted(counters.items()):
+                print(f'{name:<28}{value:>18,}')
+        hits = counters.get('cache.hits', 0)
+        misses = counters.get('cache.misses', 0)
+        if hits + misses > 0:
+            print(f'{"cache hit rate":<28}{hits / (hits + misses):>18.1%}')
+
+
+@contextlib.contextmanager
+def profile(profiler=None, profile_file=None):
+    """ Runs the block under cProfile or pyinstrument, the report goes to profile_file or stdout """
+    if profiler is None:
+        yield
+        return
+
+    if profiler == 'pyinstrument':
+        import pyinstrument
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+        try:
+            yield
+        finally:
+            profiler.stop()
+            if profile_file is not None:
+                with open(profile_file, 'w') as f:
+                    f.write(profiler.output_html())
+            else:
+                print(profiler.output_text())
+        return
+
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        if profile_file is not None:
+            profiler.dump_stats(profile_file)
+        else:
+            pstats.Stats(profiler).sort_stats('cumulative').print_stats(30)
+
+
+def add_arguments(parser):
+    parser.add_argument("--trace-file", help="Write timing spans to this JSON lines file", required=False)
+    parser.add_argument("--metrics", help="Print the table of timings and counters at the end", required=False,
+                        action='store_true')
+    parser.add_argument("--profile", help="Profile the run", required=False, choices=['cprofile', 'pyinstrument'])
+    parser.add_argument("--profile-file", help="Store the profile (cProfile stats or pyinstrument HTML) to this file",
+                        required=False)
+
+
+def run(args, fn):
+    """ Calls fn(args) with the metrics and the profiler set up by the add_arguments() options """
+    configure(args.trace_file)
+    try:
+        with profile(args.profile, args.profile_file), span('total'):
+            return fn(args)
+    finally:
+        if args.metrics:
+            summary()
+        configure()
@@ -0,0 +1,217 @@
+""" Concurrent ranged downloads from S3 with retries, progress report and a local cache """
+import concurrent.futures
+import hashlib
+import io
+import os
+import random
+import threading
+import time
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+import metrics
+
+
+def merge_ranges(ranges):
+    """ Merges adjacent or overlapping inclusive (start, end) byte ranges, end None means up to the end of file
+
+    Returns list of (start, end, [indexes of the original ranges])
+    """
+    merged = []
+    for idx in sorted(range(len(ranges)), key=lambda n: ranges[n][0]):
+        start, end = ranges[idx]
+        if merged and (merged[-1][1] is None or start <= merged[-1][1] + 1):
+            prev_start, prev_end, members = merged[-1]
+            new_end = None if end is None or prev_end is None else max(prev_end, end)
+            merged[-1] = (prev_start, new_end, members + [idx])
+        else:
+            merged.append((start, end, [idx]))
+    return merged
+
+
+def is_missing(ex):
+    return isinstance(ex, ClientError) and ex.response['Error']['Code'] == 'NoSuchKey'
+
+
+class RangeCache:
+    """ Keeps downloaded objects and byte ranges on disk, least recently used files are evicted above max_bytes
+
+    Files are named by the hash of bucket, key and range and written atomically, so an interrupted run leaves only
+    complete entries behind and the next run resumes from them.
+    """
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = sum(size for path, mtime, size in self.entries())
+
+    def entries(self):
+        result = []
+        for root, dirs, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.endswith('.tmp'):
+                    continue
+                st = os.stat(path)
+                result.append((path, st.st_mtime, st.st_size))
+        return result
+
+    def path(self, bucket, key, start, end):
+        digest = hashlib.sha1(f'{bucket}/{key}:{start}-{end}'.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def get(self, bucket, key, start=None, end=None):
+        path = self.path(bucket, key, start, end)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        # The modification time is the last access time for the LRU eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return data
+
+    def put(self, bucket, key, start, end, data):
+        path = self.path(bucket, key, start, end)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.size += len(data)
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        entries = sorted(self.entries(), key=lambda e: e[1])
+        self.size = sum(e[2] for e in entries)
+        for path, mtime, size in entries:
+            if self.size <= self.max_bytes * 0.9:
+                break
+            os.unlink(path)
+            self.size -= size
+
+
+class Fetcher:
+    def __init__(self, s3, bucket, workers=8, retries=5, backoff_sec=0.5, cache=None):
+        self.s3 = s3
+        self.bucket = bucket
+        self.cache = cache
+        self.workers = workers
+        self.retries = retries
+        self.backoff_sec = backoff_sec
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.bytes_downloaded = 0
+        self.requests = 0
+        self.cache_hits = 0
+        self.jobs_submitted = 0
+        self.jobs_done = 0
+        self.start_time = time.time()
+
+    def get(self, key, start=None, end=None):
+        """ Returns the object or its inclusive byte range from the cache or S3 """
+        if self.cache is not None:
+            data = self.cache.get(self.bucket, key, start, end)
+            if data is not None:
+                with self.lock:
+                    self.cache_hits += 1
+                metrics.count('cache.hits')
+                return data
+            metrics.count('cache.misses')
+        data = self.download(key, start, end)
+        if self.cache is not None:
+            self.cache.put(self.bucket, key, start, end, data)
+        return data
+
+    def download(self, key, start=None, end=None):
+        """ Downloads the object or its inclusive byte range, retrying with exponential backoff """
+        kwargs = {'Bucket': self.bucket, 'Key': key}
+        if start is not None:
+            kwargs['Range'] = f'bytes={start}-{"" if end is None else end}'
+        for attempt in range(self.retries + 1):
+            try:
+                with metrics.span('s3.get', key=key, range=kwargs.get('Range'), attempt=attempt):
+                    resp = self.s3.get_object(**kwargs)
+                    data = resp['Body'].read()
+                with self.lock:
+                    self.requests += 1
+                    self.bytes_downloaded += len(data)
+                metrics.count('s3.requests')
+                metrics.count('s3.bytes', len(data))
+                return data
+            except (ClientError, BotoCoreError, OSError) as ex:
+                if is_missing(ex) or attempt == self.retries:
+                    raise
+                metrics.count('s3.retries')
+                delay = self.backoff_sec * 2 ** attempt * (1 + random.random())
+                print(f'Failed to get s3://{self.bucket}/{key} {kwargs.get("Range", "")}: {ex}, '
+                      f'retrying in {delay:.1f} sec')
+                time.sleep(delay)
+
+    def get_ranges(self, key, ranges):
+        """ Returns list with the bytes of every (start, end) range, adjacent ranges are fetched by one request """
+        result = [None] * len(ranges)
+        if self.cache is not None:
+            for idx, (start, end) in enumerate(ranges):
+                result[idx] = self.cache.get(self.bucket, key, start, end)
+            hits = sum(data is not None for data in result)
+            with self.lock:
+                self.cache_hits += hits
+            metrics.count('cache.hits', hits)
+            metrics.count('cache.misses', len(ranges) - hits)
+
+        missing = [idx for idx in range(len(ranges)) if result[idx] is None]
+        for start, end, members in merge_ranges([ranges[idx] for idx in missing]):
+            print(f'Downloading range {start} {end} from s3://{self.bucket}/{key} ...')
+            data = self.download(key, start, end)
+            for idx in [missing[m] for m in members]:
+                r_start, r_end = ranges[idx]
+                result[idx] = data[r_start - start:None if r_end is None else r_end - start + 1]
+                # Records are cached one by one so other crops and filters can reuse them
+                if self.cache is not None:
+                    self.cache.put(self.bucket, key, r_start, r_end, result[idx])
+        return result
+
+    def submit(self, fn, *args):
+        with self.lock:
+            self.jobs_submitted += 1
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(self.report_progress)
+        return future
+
+    def report_progress(self, future):
+        with self.lock:
+            self.jobs_done += 1
+            elapsed = time.time() - self.start_time
+            mb = self.bytes_downloaded / 1e6
+            print(f'Progress: {self.jobs_done}/{self.jobs_submitted} jobs, {self.requests} requests, '
+                  f'{self.cache_hits} cache hits, {mb:.1f} MB in {elapsed:.0f} sec '
+                  f'({mb / max(elapsed, 1e-3):.1f} MB/s)')
+
+    def shutdown(self, cancel_futures=False):
+        self.executor.shutdown(cancel_futures=cancel_futures)
+
+
+class DirS3:
+    """ Directory backed stand-in for the S3 client, objects are stored as <root>/<bucket>/<key> """
+    def __init__(self, root):
+        self.root = root
+
+    def get_object(self, Bucket, Key, Range=None):
+        path = os.path.join(self.root, Bucket, Key)
+        if not os.path.isfile(path):
+            raise ClientError({'Error': {'Code': 'NoSuchKey', 'Message': f'{Key} not found'}}, 'GetObject')
+        with open(path, 'rb') as f:
+            if Range is None:
+                data = f.read()
+            else:
+                start, end = Range.replace('bytes=', '').split('-')
+                f.seek(int(start))
+                data = f.read() if end == '' else f.read(int(end) - int(start) + 1)
+        return {'Body': io.BytesIO(data)}
@@ -0,0 +1,344 @@
+""" Tiled store of decoded U/V fields for route corridor queries on large (CONUS HRRR, GFS) GRIBs
+
+The index is a directory (<grib>.tiles by default) with:
+  meta.json   size and modification time of the GRIB, grid definition, level, tile size, valid times and the section 1
+              and 4 of every field, so that sub GRIBs can be written from the index alone
+  u.npy v.npy (time, tile row, tile column, tile size, tile size) float32 arrays, NaN padded at the grid edges
+  lut.npz     fractional (j, i) grid indexes on a regular lat/lon lattice, projected grids only
+
+Every tile is contiguous in the memory mapped arrays, so a corridor query reads only the tiles along the route.
+"""
+import argparse
+import datetime
+import json
+import math
+import os
+import shutil
+
+import numpy as np
+
+import field_store
+import grib2
+import grib_index
+import metrics
+from grib import to_datetime64, wind_speed_dir
+
+INDEX_SUFFIX = '.tiles'
+INDEX_VERSION = 2
+TILE_SIZE = 64
+LUT_STEP = 0.05
+LUT_MAX_CELLS = 4000000
+KM_PER_DEG = 111.195
+WIND_VARS = field_store.WIND_VARS
+WIND_LEVEL = field_store.WIND_LEVEL
+
+
+def index_name(grib_name):
+    return grib_name + INDEX_SUFFIX
+
+
+def spacing_km(grid):
+    """ Returns the smallest distance between neighbour grid points [km] """
+    if isinstance(grid, grib2.LambertGrid):
+        return min(grid.dx, grid.dy) / 1000
+    return min(grid.di, grid.dj) * KM_PER_DEG
+
+
+def make_lut(grid, step):
+    """ Returns (lat0, lon0, step, j, i) arrays of the grid indexes on the lattice covering the grid """
+    edge_j = np.concatenate((np.zeros(grid.ni), np.full(grid.ni, grid.nj - 1), np.arange(grid.nj),
+                             np.arange(grid.nj)))
+    edge_i = np.concatenate((np.arange(grid.ni), np.arange(grid.ni), np.zeros(grid.nj), np.full(grid.nj, grid.ni - 1)))
+    lats, lons = grid.latlon(edge_j, edge_i)
+    lat0, lat1 = math.floor(lats.min()) - 1, math.ceil(lats.max()) + 1
+    lon0, lon1 = math.floor(lons.min()) - 1, math.ceil(lons.max()) + 1
+    # Coarser lattice for the grids covering a big part of the globe
+    step = max(step, math.sqrt((lat1 - lat0) * (lon1 - lon0) / LUT_MAX_CELLS))
+    lut_lats = np.arange(lat0, lat1 + step, step)
+    lut_lons = np.arange(lon0, lon1 + step, step)
+    j, i = grid.ij(*np.meshgrid(lut_lats, lut_lons, indexing='ij'))
+    return lat0, lon0, step, j.astype(np.float32), i.astype(np.float32)
+
+
+class TileIndex:
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.grid = grib2.make_grid(bytes.fromhex(self.meta['grid']), 0)
+        self.tile_size = self.meta['tile_size']
+        self.times = np.array(self.meta['times'], dtype='datetime64[s]')
+        self.tiles = {name: np.load(os.path.join(index_dir, f'{name}.npy'), mmap_mode='r')
+                      for name in WIND_VARS.values()}
+        self.lut = None
+        lut_name = os.path.join(index_dir, 'lut.npz')
+        if os.path.exists(lut_name):
+            self.lut = dict(np.load(lut_name))
+
+    def ij(self, lat, lon):
+        """ Returns fractional (j, i) grid indexes of the points, bilinear in the lookup table of projected grids """
+        if self.lut is None:
+            return self.grid.ij(lat, lon)
+        step = float(self.lut['step'])
+        y = (np.asarray(lat, dtype=np.float64) - float(self.lut['lat0'])) / step
+        x = (grib2.wrap_lon(lon) - float(self.lut['lon0'])) / step
+        lut_j, lut_i = self.lut['j'], self.lut['i']
+        y0 = np.clip(np.floor(y).astype(np.int64), 0, lut_j.shape[0] - 2)
+        x0 = np.clip(np.floor(x).astype(np.int64), 0, lut_j.shape[1] - 2)
+        fy = y - y0
+        fx = x - x0
+
+        def bilinear(a):
+            return ((a[y0, x0] * (1 - fx) + a[y0, x0 + 1] * fx) * (1 - fy) +
+                    (a[y0 + 1, x0] * (1 - fx) + a[y0 + 1, x0 + 1] * fx) * fy)
+        return bilinear(lut_j), bilinear(lut_i)
+
+    def read_window(self, name, t, j0, j1, i0, i1):
+        """ Returns the values of the grid rows j0..j1 and columns i0..i1 at the time slot t """
+        size = self.tile_size
+        values = np.empty((j1 - j0 + 1, i1 - i0 + 1), dtype=np.float32)
+        for tj in range(j0 // size, j1 // size + 1):
+            for ti in range(i0 // size, i1 // size + 1):
+                tile = self.tiles[name][t, tj, ti]
+                a0, a1 = max(j0, tj * size), min(j1, tj * size + size - 1)
+                b0, b1 = max(i0, ti * size), min(i1, ti * size + size - 1)
+                values[a0 - j0:a1 - j0 + 1, b0 - i0:b1 - i0 + 1] = \
+                    tile[a0 - tj * size:a1 - tj * size + 1, b0 - ti * size:b1 - ti * size + 1]
+        return values
+
+    def time_slots(self, start_time=None, end_time=None):
+        sel = np.ones(len(self.times), dtype=bool)
+        if start_time is not None:
+            sel &= self.times >= np.datetime64(start_time, 's')
+        if end_time is not None:
+            sel &= self.times <= np.datetime64(end_time, 's')
+        return np.nonzero(sel)[0]
+
+    def corridor(self, lats, lons, radius_km):
+        """ Returns (j, i) indexes of the grid points within radius_km of the route polyline """
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        step_km = spacing_km(self.grid) / 2
+        dense_lats, dense_lons = [lats[:1]], [lons[:1]]
+        for n in range(1, len(lats)):
+            seg_km = distance_km(lats[n - 1], lons[n - 1], lats[n], lons[n])
+            num = max(int(math.ceil(seg_km / step_km)), 1)
+            dense_lats.append(np.linspace(lats[n - 1], lats[n], num + 1)[1:])
+            dense_lons.append(lons[n - 1] + grib2.wrap_lon(lons[n] - lons[n - 1]) * np.linspace(0, 1, num + 1)[1:])
+        dense_lats = np.concatenate(dense_lats)
+        dense_lons = np.concatenate(dense_lons)
+        route_j, route_i = self.ij(dense_lats, dense_lons)
+
+        # Tiles touched by the corridor
+        size = self.tile_size
+        tiles_j, tiles_i = self.tiles['u'].shape[1:3]
+        r_cells = radius_km / spacing_km(self.grid) + 1
+        touched = np.zeros((tiles_j, tiles_i), dtype=bool)
+        tj0 = np.clip(np.floor((route_j - r_cells) / size), 0, tiles_j - 1).astype(np.int64)
+        tj1 = np.clip(np.floor((route_j + r_cells) / size), -1, tiles_j - 1).astype(np.int64)
+        ti0 = np.clip(np.floor((route_i - r_cells) / size), 0, tiles_i - 1).astype(np.int64)
+        ti1 = np.clip(np.floor((route_i + r_cells) / size), -1, tiles_i - 1).astype(np.int64)
+        for a0, a1, b0, b1 in set(zip(tj0, tj1, ti0, ti1)):
+            touched[a0:a1 + 1, b0:b1 + 1] = True
+
+        result_j, result_i = [], []
+        for tj, ti in zip(*np.nonzero(touched)):
+            j, i = np.mgrid[tj * size:min((tj + 1) * size, self.grid.nj), ti * size:min((ti + 1) * size, self.grid.ni)]
+            j, i = j.ravel(), i.ravel()
+            near = ((route_j > j[0] - r_cells) & (route_j < j[-1] + r_cells) &
+                    (route_i > i[0] - r_cells) & (route_i < i[-1] + r_cells))
+            if not np.any(near):
+                continue
+            lat, lon = self.grid.latlon(j, i)
+            dist = distance_km(lat[:, np.newaxis], lon[:, np.newaxis], dense_lats[near], dense_lons[near]).min(axis=1)
+            inside = dist <= radius_km
+            result_j.append(j[inside])
+            result_i.append(i[inside])
+        if len(result_j) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return np.concatenate(result_j), np.concatenate(result_i)
+
+    def sample_corridor(self, lats, lons, radius_km, start_time=None, end_time=None):
+        """ Returns dict of (time, point) arrays: utc, lat, lon, u, v of the corridor points between the times """
+        j, i = self.corridor(lats, lons, radius_km)
+        slots = self.time_slots(start_time, end_time)
+        size = self.tile_size
+        result = {'utc': np.repeat(self.times[slots], len(j)).reshape(len(slots), len(j))}
+        lat, lon = self.grid.latlon(j, i)
+        result['lat'] = np.broadcast_to(lat, (len(slots), len(j)))
+        result['lon'] = np.broadcast_to(lon, (len(slots), len(j)))
+        for name in WIND_VARS.values():
+            result[name] = np.stack([self.tiles[name][t, j // size, i // size, j % size, i % size] for t in slots]) \
+                if len(slots) else np.zeros((0, len(j)), dtype=np.float32)
+        return result
+
+    def export_grib(self, out_grib_name, lats, lons, radius_km, start_time=None, end_time=None):
+        """ Writes U and V of the smallest sub grid covering the corridor between the times """
+        j, i = self.corridor(lats, lons, radius_km)
+        if len(j) == 0:
+            raise grib2.Grib2Error('The route is outside of the grid')
+        j0, j1, i0, i1 = j.min(), j.max(), i.min(), i.max()
+        grid_definition = self.grid.subgrid_definition(j0, j1, i0, i1)
+        print(f'Writing {out_grib_name} {j1 - j0 + 1} x {i1 - i0 + 1}')
+        with open(out_grib_name, 'wb') as f:
+            for t in self.time_slots(start_time, end_time):
+                for var, name in WIND_VARS.items():
+                    product = self.meta['products'][var][t]
+                    if product is None:
+                        continue
+                    values = self.read_window(name, t, j0, j1, i0, i1)
+                    f.write(grib2.build_message(product['discipline'], [
+                        bytes.fromhex(product['sec1']), grid_definition, bytes.fromhex(product['sec4']),
+                        grib2.encode_data(values, *product['scales'])]))
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """ Equirectangular approximation, good enough at the corridor scale """
+    x = grib2.wrap_lon(np.asarray(lon2) - lon1) * np.cos(np.radians((np.asarray(lat1) + lat2) / 2))
+    y = np.asarray(lat2) - lat1
+    return np.hypot(x, y) * KM_PER_DEG
+
+
+def open_tile_index(grib_name, index_dir=None, level=WIND_LEVEL):
+    """ Returns TileIndex of the GRIB level or None if it was not built or the GRIB changed since """
+    index_dir = index_name(grib_name) if index_dir is None else index_dir
+    try:
+        st = os.stat(grib_name)
+        index = TileIndex(index_dir)
+    except (OSError, ValueError, KeyError):
+        return None
+    if not field_store.is_current(index.meta, st, INDEX_VERSION, level):
+        return None
+    return index
+
+
+def build_tile_index(grib_name, index_dir=None, tile_size=TILE_SIZE, lut_step=LUT_STEP, level=WIND_LEVEL):
+    """ Decodes U and V fields of the level to tiles, only the first ensemble member of an ensemble GRIB is kept """
+    index_dir = index_name(grib_name) if index_dir is None else index_dir
+    st = os.stat(grib_name)
+    records = grib_index.load_inventory(grib_name)
+    wind = [r for r in records if r['var'] in WIND_VARS and r['level'] == level]
+    if len(wind) == 0:
+        raise grib2.Grib2Error(f'{grib_name} has no UGRD or VGRD fields at {level}')
+    member = min(r['member'] for r in wind)
+    wind = [r for r in wind if r['member'] == member]
+    if len({r['grid'] for r in wind}) > 1:
+        raise grib2.Grib2Error(f'{grib_name} has fields on different grids')
+
+    grid_hex = wind[0]['grid']
+    grid = grib2.make_grid(bytes.fromhex(grid_hex), 0)
+    times = sorted({r['valid_time'] for r in wind})
+    tiles_j = -(-grid.nj // tile_size)
+    tiles_i = -(-grid.ni // tile_size)
+    shape = (len(times), tiles_j, tiles_i, tile_size, tile_size)
+    print(f'Building tile index {index_dir} {shape}')
+
+    tmp_dir = f'{index_dir}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    tiles = {}
+    for name in WIND_VARS.values():
+        tiles[name] = np.lib.format.open_memmap(os.path.join(tmp_dir, f'{name}.npy'), mode='w+', dtype=np.float32,
+                                                shape=shape)
+        tiles[name][:] = np.nan
+
+    products = {var: [None] * len(times) for var in WIND_VARS}
+    padded = np.full((tiles_j * tile_size, tiles_i * tile_size), np.nan, dtype=np.float32)
+    with metrics.span('tiles.build', grib=grib_name), open(grib_name, 'rb') as f:
+        for record in wind:
+            f.seek(record['offset'])
+            message = grib2.Message(f.read(record['length']), record['offset'])
+            field = message.fields()[record['field']]
+            t = times.index(record['valid_time'])
+            padded[:grid.nj, :grid.ni] = field.values()
+            tiles[WIND_VARS[record['var']]][t] = \
+                padded.reshape(tiles_j, tile_size, tiles_i, tile_size).transpose(0, 2, 1, 3)
+            products[record['var']][t] = {
+                'discipline': message.discipline,
+                'sec1': grib2.section_bytes(message.buf, message.section(1)).hex(),
+                'sec4': field.product_definition.hex(),
+                'scales': field.scales,
+            }
+            metrics.count('grib.fields_decoded')
+    for array in tiles.values():
+        array.flush()
+    del tiles
+
+    if not isinstance(grid, grib2.LatLonGrid):
+        lat0, lon0, step, lut_j, lut_i = make_lut(grid, lut_step)
+        np.savez(os.path.join(tmp_dir, 'lut.npz'), lat0=lat0, lon0=lon0, step=step, j=lut_j, i=lut_i)
+
+    meta = {
+        'version': INDEX_VERSION,
+        'size': st.st_size,
+        'mtime_ns': st.st_mtime_ns,
+        'grid': grid_hex,
+        'level': level,
+        'tile_size': tile_size,
+        'times': [t.strftime(grib_index.TIME_FORMAT) for t in times],
+        'products': products,
+    }
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.replace(tmp_dir, index_dir)
+    return TileIndex(index_dir)
+
+
+def read_route(gpx_name):
+    import gpxpy
+    with open(gpx_name, 'r') as gpx_file:
+        gpx = gpxpy.parse(gpx_file)
+    points = [point for route in gpx.routes for point in route.points] + \
+             [point for track in gpx.tracks for segment in track.segments for point in segment.points]
+    return np.array([p.latitude for p in points]), np.array([p.longitude for p in points])
+
+
+def route_corridor(args):
+    index = open_tile_index(args.grib_file, level=args.level)
+    if index is None:
+        index = build_tile_index(args.grib_file, tile_size=args.tile_size, level=args.level)
+    if args.gpx_file is None:
+        return
+
+    start_time = None if args.start_time is None else datetime.datetime.strptime(args.start_time, '%Y-%m-%d %H:%M')
+    end_time = None if args.end_time is None else datetime.datetime.strptime(args.end_time, '%Y-%m-%d %H:%M')
+    lats, lons = read_route(args.gpx_file)
+
+    if args.csv_file is not None:
+        with metrics.span('tiles.corridor'):
+            corridor = index.sample_corridor(lats, lons, args.radius_km, start_time, end_time)
+        speed, direction = wind_speed_dir(corridor['u'], corridor['v'])
+        with open(args.csv_file, 'wt') as out_csv:
+            out_csv.write('UTC,Lat,Lon,TWS,TWD\n')
+            for row in zip(to_datetime64(corridor['utc'].ravel()).astype(object), corridor['lat'].ravel(),
+                           corridor['lon'].ravel(), speed.ravel(), direction.ravel()):
+                out_csv.write(f'{row[0]},{row[1]:.5f},{row[2]:.5f},{row[3]:.1f},{row[4]:.0f}\n')
+        print(f'{args.csv_file} created with {corridor["u"].size} values')
+
+    if args.out_grib is not None:
+        with metrics.span('tiles.export'):
+            index.export_grib(args.out_grib, lats, lons, args.radius_km, start_time, end_time)
+
+
+def add_arguments(parser):
+    parser.add_argument("--grib-file", help="GRIB file to index", required=True)
+    parser.add_argument("--tile-size", help="Tile size in grid points", type=int, default=TILE_SIZE)
+    parser.add_argument("--level", help="Level of the wind as wgrib2 prints it", default=WIND_LEVEL)
+    parser.add_argument("--gpx-file", help="GPX route of the corridor", required=False)
+    parser.add_argument("--radius-km", help="Half width of the corridor [km]", type=float, default=20)
+    parser.add_argument("--start-time", help="Start of the time window UTC YYYY-MM-DD HH:MM", required=False)
+    parser.add_argument("--end-time", help="End of the time window UTC YYYY-MM-DD HH:MM", required=False)
+    parser.add_argument("--csv-file", help="CSV file with the wind at every corridor point", required=False)
+    parser.add_argument("--out-grib", help="Sub GRIB covering the corridor for the routing software", required=False)
+
+
+def main(args):
+    route_corridor(args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+    add_arguments(parser)
+    metrics.add_arguments(parser)
+    metrics.run(parser.parse_args(), main)
@@ -1,54 +1,136 @@
 import argparse
+import collections
+import concurrent.futures
 import datetime
-from moviepy.editor import *
 
-from PIL import Image, ImageDraw, ImageFont
+import numpy as np
+
+import metrics
+
+TIDAL_CYCLE_SEC = (25 * 60 + 30) * 60
+OVERLAY_SIZE = (800, 80)
+
+# Font of the process rendering the overlays
+fonts = {}
+
+
+def render_overlay(text, font_name, font_size):
+    """ Returns RGBA array with the text """
+    from PIL import Image, ImageDraw, ImageFont
+    if (font_name, font_size) not in fonts:
+        fonts[(font_name, font_size)] = ImageFont.truetype(font_name, font_size)
+    img = Image.new('RGBA', OVERLAY_SIZE, (0, 255, 255, 0))
+    d = ImageDraw.Draw(img)
+    d.text((0, 0), text, font=fonts[(font_name, font_size)], fill=(255, 255, 0))
+    return np.asarray(img)
+
+
+def blend(frame, overlay, x, y):
+    """ Returns the frame with the RGBA overlay drawn with its top left corner at (x, y) """
+    h = min(overlay.shape[0], frame.shape[0] - y)
+    w = min(overlay.shape[1], frame.shape[1] - x)
+    overlay = overlay[:h, :w]
+    alpha = overlay[..., 3:4].astype(np.float32) / 255
+    out = frame.copy()
+    region = out[y:y + h, x:x + w, :3].astype(np.float32)
+    out[y:y + h, x:x + w, :3] = (region * (1 - alpha) + overlay[..., :3] * alpha).astype(frame.dtype)
+    return out
+
+
+class TimeLine:
+    """ Renders the overlay of every frame on demand
+
+    With workers > 1 the overlays of the next frames are rendered ahead in a process pool, at most 4 * workers of
+    them are kept in memory.
+    """
+    def __init__(self, start_time, dt, font_name, font_size, workers=1):
+        self.start_time = start_time
+        self.dt = dt
+        self.font_name = font_name
+        self.font_size = font_size
+        self.executor = None
+        self.pending = collections.OrderedDict()
+        self.ahead = 4 * workers
+        if workers > 1:
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+
+    def text(self, i):
+        time = self.start_time + datetime.timedelta(seconds=i * self.dt)
+        return time.strftime("%m/%d/%Y %H:%M:%S")
+
+    def overlay(self, i):
+        if self.executor is None:
+            return render_overlay(self.text(i), self.font_name, self.font_size)
+
+        # Frames are requested in order, drop the ones behind and keep the window ahead filled
+        for n in [n for n in self.pending if n < i or n > i + self.ahead]:
+            self.pending.pop(n).cancel()
+        for n in range(i, i + self.ahead):
+            if n not in self.pending:
+                self.pending[n] = self.executor.submit(render_overlay, self.text(n), self.font_name, self.font_size)
+        return self.pending.pop(i).result()
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
 
 
 def make_time_line(args):
+    from moviepy.editor import VideoFileClip, vfx
+
     print(f'Reading tide clip {args.input_clip} ...')
     tide_clip = VideoFileClip(args.input_clip)
-    frames_num = len(list(tide_clip.iter_frames()))
-    # frames_num = 2
+    # Frame count from the container metadata instead of decoding the whole clip
+    frames_num = getattr(tide_clip.reader, 'nframes', None) or int(round(tide_clip.duration * tide_clip.fps))
     start_time = datetime.datetime.strptime(args.start_time, '%Y-%m-%d %H:%M')
-    tidal_cycle_sec = (25 * 60 + 30) * 60
-    dt = tidal_cycle_sec / frames_num
-
-    fnt = ImageFont.truetype('/Library/Fonts/Arial.ttf', 84)
-    file_list = []
-    print(f'Creating time line clip')
-    for i in range(frames_num):
-        time = start_time + datetime.timedelta(seconds=i * dt)
-        str_time = time.strftime("%m/%d/%Y %H:%M:%S")
-        print('.', end='')
-
-        filename = args.work_dir + os.sep + f'timeline-{i:03d}.png'
-        img = Image.new('RGBA', (800, 80), (0, 255, 255, 0))
-        d = ImageDraw.Draw(img)
-        d.text((0, 0), str_time, font=fnt,  fill=(255, 255, 0))
-
-        img.save(filename)
-        file_list.append(filename)
-
-    print('')
-    time_line = ImageSequenceClip(file_list, fps=tide_clip.fps)
-    # Position te time line
-    x = tide_clip.w/2 - time_line.w/2
-    y = time_line.h/2
+    dt = TIDAL_CYCLE_SEC / frames_num
+    print(f'{frames_num} frames, {dt:.0f} sec per frame')
+
+    time_line = TimeLine(start_time, dt, args.font, args.font_size, args.workers)
+    # Position the time line
+    x = int(tide_clip.w / 2 - OVERLAY_SIZE[0] / 2)
+    y = int(OVERLAY_SIZE[1] / 2)
+
+    def draw_time_line(get_frame, t):
+        i = min(int(round(t * tide_clip.fps)), frames_num - 1)
+        return blend(get_frame(t), time_line.overlay(i), max(x, 0), y)
+
     print(f'Creating composed clip')
-    full_video = CompositeVideoClip([tide_clip, time_line.set_position((x, y))])
-    race_video = full_video.subclip(5, 12)
-    slow_race_video = race_video.fx(vfx.speedx, 0.5)
+    video = tide_clip.fl(draw_time_line)
+    if args.subclip_start is not None or args.subclip_end is not None:
+        video = video.subclip(args.subclip_start or 0, args.subclip_end)
+    if args.speed != 1:
+        video = video.fx(vfx.speedx, args.speed)
 
     print(f'Storing {args.output_clip} ...')
-    slow_race_video.write_videofile(args.output_clip)
+    try:
+        with metrics.span('timeline.write', clip=args.output_clip):
+            video.write_videofile(args.output_clip, threads=args.workers)
+    finally:
+        time_line.shutdown()
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+def add_arguments(parser):
     parser.add_argument("--input-clip", help="Input clip", required=True)
     parser.add_argument("--output-clip", help="Output clip", required=True)
     parser.add_argument("--start-time", help="Slack before the max ebb time YYYY-MM-DD HH:MM", required=True)
-    parser.add_argument("--work-dir", help="Directory to keep clips", default='./data/movie')
-    params = parser.parse_args()
-    make_time_line(params)
+    parser.add_argument("--subclip-start", help="Start of the output in the input clip [sec]", type=float, default=5)
+    parser.add_argument("--subclip-end", help="End of the output in the input clip [sec]", type=float, default=12)
+    parser.add_argument("--speed", help="Speed factor of the output clip", type=float, default=0.5)
+    parser.add_argument("--font", help="TrueType font of the time line", default='/Library/Fonts/Arial.ttf')
+    parser.add_argument("--font-size", help="Font size of the time line", type=int, default=84)
+    parser.add_argument("--workers", help="Processes rendering the time line ahead and ffmpeg threads", type=int,
+                        default=1)
+    parser.add_argument("--work-dir", help="Directory to keep clips (not used, frames are not stored any more)",
+                        default='./data/movie')
+
+
+def main(args):
+    make_time_line(args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+    add_arguments(parser)
+    metrics.add_arguments(parser)
+    metrics.run(parser.parse_args(), main)
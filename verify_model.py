@@ -1,45 +1,200 @@
 import argparse
+import concurrent.futures
 import csv
-import datetime
+import glob
+import math
+import os
 
-from grib import Grib
+import numpy as np
+
+import metrics
+from grib import Grib, angle_diff
+
+CHUNK_ROWS = 100000
+
+
+def parse_utc(dates, local_times, zones):
+    """ Converts Date (DD:MM:YYYY), LocalTime (HH:MM:SS.fff) and Zone columns to UTC datetime64 array """
+    iso = []
+    for date, local_time in zip(dates, local_times):
+        day, month, year = date.split(':')
+        hour, rest = local_time.split(':', 1)
+        iso.append(f'{year}-{month:0>2}-{day:0>2}T{hour:0>2}:{rest}')
+    local = np.array(iso, dtype='datetime64[ms]')
+    return local - np.array(zones, dtype=np.int64).astype('timedelta64[h]')
+
+
+def parse_floats(cells):
+    """ Converts the CSV cells to float64 array, blank cells are NaN """
+    return np.array([float(c) if len(c.strip()) > 0 else np.nan for c in cells], dtype=np.float64)
+
+
+def read_log_chunks(csv_name, step_minutes, chunk_rows=CHUNK_ROWS):
+    """ Yields decimated chunks of the nav log as dict of arrays: utc, lat, lon, tws, twd """
+    step = np.timedelta64(step_minutes * 60 * 1000, 'ms')
+    start_time = None
+    last_bucket = None
+    with open(csv_name, 'r') as csv_file:
+        csv_reader = csv.reader(csv_file, delimiter=',', quotechar='|')
+        header = next(csv_reader)
+        columns = {name: header.index(name) for name in
+                   ['Date', 'LocalTime', 'Zone', 'Lat', 'Lon', 'yTWS', 'yTWA', 'yCOG']}
+        while True:
+            rows = [row for _, row in zip(range(chunk_rows), csv_reader)]
+            if len(rows) == 0:
+                return
+            cols = {name: [row[idx] for row in rows] for name, idx in columns.items()}
+            utc = parse_utc(cols['Date'], cols['LocalTime'], cols['Zone'])
+
+            # Keep the first row of every step_minutes interval
+            if start_time is None:
+                start_time = utc[0]
+            bucket = (utc - start_time) // step if step_minutes > 0 else np.arange(len(utc))
+            prev_bucket = np.concatenate(([last_bucket if last_bucket is not None else bucket[0] - 1], bucket[:-1]))
+            last_bucket = bucket[-1]
+            keep = bucket != prev_bucket
+
+            # Only the kept rows are parsed, rows with blank cells are dropped, e.g. without COG there is no TWD
+            kept = np.flatnonzero(keep)
+            values = {name: parse_floats([cols[name][n] for n in kept])
+                      for name in ['Lat', 'Lon', 'yTWS', 'yTWA', 'yCOG']}
+            complete = np.all([~np.isnan(v) for v in values.values()], axis=0)
+            if not np.any(complete):
+                continue
+
+            yield {
+                'utc': utc[kept[complete]],
+                'lat': values['Lat'][complete],
+                'lon': values['Lon'][complete],
+                'tws': values['yTWS'][complete],
+                'twd': (values['yCOG'][complete] + values['yTWA'][complete]) % 360,
+            }
+
+
+class ErrorStats:
+    """ Running bias and RMSE of the speed and circular error of the direction, model minus instruments """
+    def __init__(self):
+        self.count = 0
+        self.speed_sum = 0.0
+        self.speed_sq_sum = 0.0
+        self.dir_sin_sum = 0.0
+        self.dir_cos_sum = 0.0
+        self.dir_abs_sum = 0.0
+
+    def update(self, tws, gws, twd, gwd):
+        valid = ~np.isnan(gws) & ~np.isnan(gwd)
+        speed_err = gws[valid] - tws[valid]
+        dir_err = angle_diff(gwd[valid], twd[valid])
+        self.count += int(np.sum(valid))
+        self.speed_sum += float(np.sum(speed_err))
+        self.speed_sq_sum += float(np.sum(speed_err ** 2))
+        self.dir_sin_sum += float(np.sum(np.sin(np.radians(dir_err))))
+        self.dir_cos_sum += float(np.sum(np.cos(np.radians(dir_err))))
+        self.dir_abs_sum += float(np.sum(np.abs(dir_err)))
+
+    def summary(self):
+        if self.count == 0:
+            return {'count': 0}
+        return {
+            'count': self.count,
+            'speed_bias': self.speed_sum / self.count,
+            'speed_rmse': math.sqrt(self.speed_sq_sum / self.count),
+            'dir_bias': math.degrees(math.atan2(self.dir_sin_sum, self.dir_cos_sum)),
+            'dir_mae': self.dir_abs_sum / self.count,
+        }
 
 
 def verify_model(args):
     grib = Grib(args.grib_file)
+    stats = ErrorStats()
+
+    with open(args.out_csv, 'wt') as out_csv:
+        writer = csv.writer(out_csv)
+        writer.writerow(['utc', 'tws', 'gws', 'twd', 'gwd'])
+        for chunk in read_log_chunks(args.csv_file, args.step_minutes):
+            print(f'Sampling GRIB at {len(chunk["utc"])} points ...')
+            with metrics.span('sample'):
+                gws, gwd = grib.sample_many(chunk['utc'], chunk['lat'], chunk['lon'])
+            metrics.count('points', len(gws))
+            stats.update(chunk['tws'], gws, chunk['twd'], gwd)
+            for row in zip(chunk['utc'].astype('datetime64[us]').astype(object), chunk['tws'], gws, chunk['twd'],
+                           gwd):
+                writer.writerow(['' if isinstance(v, float) and math.isnan(v) else v for v in row])
+
+    summary = stats.summary()
+    print(' '.join(f'{k}={v:.2f}' if isinstance(v, float) else f'{k}={v}' for k, v in summary.items()))
+    return summary
+
 
-    with open(args.csv_file, 'r') as csv_file, open(args.out_csv, 'wt') as out_csv:
-        csv_reader = csv.DictReader(csv_file, delimiter=',', quotechar='|')
-        writer = csv.DictWriter(out_csv, fieldnames=['utc', 'tws', 'gws', 'twd', 'gwd'])
+# Decoded nav log shared by the worker processes
+nav_log = None
+
+
+def init_worker(log):
+    global nav_log
+    nav_log = log
+
+
+def evaluate_grib(grib_file):
+    gws, gwd = Grib(grib_file).sample_many(nav_log['utc'], nav_log['lat'], nav_log['lon'])
+    stats = ErrorStats()
+    stats.update(nav_log['tws'], gws, nav_log['twd'], gwd)
+    print(f'{grib_file} evaluated')
+    return stats.summary()
+
+
+def compare_models(args):
+    """ Evaluates every GRIB against the nav log parsed once, writes the table ranked by the speed RMSE """
+    pattern = os.path.join(args.grib_glob, '*.grib2') if os.path.isdir(args.grib_glob) else args.grib_glob
+    grib_files = sorted(glob.glob(pattern))
+    chunks = list(read_log_chunks(args.csv_file, args.step_minutes))
+    if len(chunks) == 0:
+        raise SystemExit(f'No complete rows with the time, position, TWS and TWD in {args.csv_file}')
+    log = {k: np.concatenate([c[k] for c in chunks]) for k in ['utc', 'lat', 'lon', 'tws', 'twd']}
+    print(f'Comparing {len(grib_files)} GRIBs at {len(log["utc"])} points')
+
+    with metrics.span('evaluate'), \
+            concurrent.futures.ProcessPoolExecutor(max_workers=args.workers, initializer=init_worker,
+                                                   initargs=(log,)) as executor:
+        summaries = list(executor.map(evaluate_grib, grib_files))
+
+    table = []
+    for grib_file, summary in zip(grib_files, summaries):
+        summary['model'] = os.path.splitext(os.path.basename(grib_file))[0]
+        table.append(summary)
+    # GRIBs not covering the log go to the bottom
+    table.sort(key=lambda r: (r['count'] == 0, r.get('speed_rmse', 0), r.get('dir_mae', 0)))
+
+    fields = ['rank', 'model', 'count', 'speed_bias', 'speed_rmse', 'dir_bias', 'dir_mae']
+    with open(args.out_csv, 'wt') as out_csv:
+        writer = csv.DictWriter(out_csv, fieldnames=fields)
         writer.writeheader()
-        prev_utc_time = None
-        for row in csv_reader:
-            local_time = datetime.datetime.strptime(row['Date'] + ' ' + row['LocalTime'], '%d:%m:%Y %H:%M:%S.%f')
-            utc_time = local_time - datetime.timedelta(hours=int(row['Zone']))
-            if prev_utc_time is None:
-                prev_utc_time = utc_time
-            if (utc_time - prev_utc_time).total_seconds() >= args.step_minutes * 60:
-                prev_utc_time = utc_time
-                lat = float(row['Lat'])
-                lon = float(row['Lon'])
-                tws = float(row['yTWS'])
-                twa = float(row['yTWA'])
-                sow = float(row['ySpeed'])
-                sog = float(row['ySOG'])
-                cog = float(row['yCOG']) if len(row['yCOG']) > 0 else None
-
-                if cog is not None:
-                    twd = (cog + twa) % 360
-                    print(f'{utc_time} {tws} {twd} {lat} {lon}')
-                    gws, gwd = grib.get_wind_from_grib(utc_time, lat, lon)
-                    writer.writerow({'utc': utc_time, 'tws': tws, 'gws': gws, 'twd': twd, 'gwd': gwd})
+        for rank, row in enumerate(table, start=1):
+            writer.writerow({'rank': rank, **{k: f'{v:.2f}' if isinstance(v, float) else v for k, v in row.items()}})
+    print(f'{args.out_csv} created')
+    return table
 
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
-    parser.add_argument("--grib-file", help="GRIB file", required=True)
+def add_arguments(parser):
+    grib_group = parser.add_mutually_exclusive_group(required=True)
+    grib_group.add_argument("--grib-file", help="GRIB file")
+    grib_group.add_argument("--grib-glob", help="Directory or glob of GRIBs to rank against the boat data, "
+                                                "--out-csv gets the skill table")
     parser.add_argument("--csv-file", help="CSV file containing the boat data", required=True)
     parser.add_argument("--out-csv", help="CSV file containing the comparison", required=True)
     parser.add_argument("--step-minutes", help="CSV file containing the boat data", required=False,
                         type=int, default=1)
-    verify_model(parser.parse_args())
+    parser.add_argument("--workers", help="Number of processes comparing GRIBs", type=int, default=os.cpu_count())
+
+
+def main(args):
+    if args.grib_glob is not None:
+        return compare_models(args)
+    return verify_model(args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+    add_arguments(parser)
+    metrics.add_arguments(parser)
+    metrics.run(parser.parse_args(), main)
@@ -1,49 +1,139 @@
 import argparse
+import concurrent.futures
 import glob
 import os
+import warnings
 
-import gpxpy
-import gpxpy.gpx
+import numpy as np
 
-from grib import Grib
+import metrics
+from grib import Grib, circular_mean_std, to_datetime64, wind_speed_dir
+
+# Route points shared by the worker processes
+route = None
+
+
+def init_worker(times, lats, lons):
+    global route
+    route = (times, lats, lons)
+
+
+def sample_grib(grib_file):
+    grib = Grib(grib_file)
+    print(f'Sampling {grib_file} at {len(route[0])} route points')
+    speeds, directions = grib.sample_many(*route)
+    return speeds.astype(np.float32), directions.astype(np.float32)
+
+
+def sample_grib_dir(grib_dir, workers, times, lats, lons):
+    """ Returns member names and (time x member) speed and direction arrays, every GRIB in the directory is a member """
+    grib_files = sorted(glob.glob(grib_dir + '/*.grib2'))
+    names = [os.path.basename(grib_file).split('.')[0] for grib_file in grib_files]
+
+    # A member missing some time slot leaves NaN there
+    speeds = np.full((len(times), len(grib_files)), np.nan, dtype=np.float32)
+    directions = np.full((len(times), len(grib_files)), np.nan, dtype=np.float32)
+    with metrics.span('sample'), \
+            concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                                   initargs=(times, lats, lons)) as executor:
+        for member, (s, d) in enumerate(executor.map(sample_grib, grib_files)):
+            speeds[:, member] = s
+            directions[:, member] = d
+    return names, speeds, directions
+
+
+def sample_ensemble(ens_grib, times, lats, lons):
+    """ Returns member names and (time x member) speed and direction arrays of all members of the ensemble GRIB
+
+    The members are sampled together from the field store, it is materialized first if needed
+    """
+    grib = Grib(ens_grib)
+    store = grib.open_store()
+    if store is None:
+        store = grib.materialize()
+    print(f'Sampling {len(store.members)} members of {ens_grib} at {len(times)} route points')
+    with metrics.span('sample', grib=ens_grib):
+        u, v = store.sample_uv(times, lats, lons)
+    speeds, directions = wind_speed_dir(u, v)
+    names = [f'member{m}' for m in store.members]
+    return names, speeds.astype(np.float32), directions.astype(np.float32)
+
+
+def time_slot_stats(speeds, directions):
+    """ Returns per time slot statistics of the (time x member) arrays """
+    with warnings.catch_warnings():
+        # Time slots not covered by any member are NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        p10, p50, p90 = np.nanpercentile(speeds, [10, 50, 90], axis=1)
+        mean_dir, dir_spread = circular_mean_std(directions, axis=1)
+        return {
+            'count': np.sum(~np.isnan(speeds), axis=1),
+            'mean': np.nanmean(speeds, axis=1),
+            'std': np.nanstd(speeds, axis=1),
+            'p10': p10,
+            'p50': p50,
+            'p90': p90,
+            'mean_dir': mean_dir,
+            'dir_spread': dir_spread,
+        }
 
 
 def wind_stat(args):
-    time_slots = {}
-    with open(args.gpx_file, 'r') as gpx_file, open(args.csv_file, 'wt') as out_csv:
+    import gpxpy
+    with open(args.gpx_file, 'r') as gpx_file:
         gpx = gpxpy.parse(gpx_file)
+    points = sorted((point for route in gpx.routes for point in route.points), key=lambda p: p.time)
+    times = to_datetime64([point.time for point in points])
+    lats = np.array([point.latitude for point in points])
+    lons = np.array([point.longitude for point in points])
 
-        # Read list of GRIB files from args.grib_dir
-        grib_files = glob.glob(args.grib_dir + '/*.grib2')
-        out_csv.write(f'UTC')
-        for grib_file in grib_files:
-            name = os.path.basename(grib_file).split('.')[0]
-            out_csv.write(f',{name}')
-            grib = Grib(grib_file)
-
-            for route in gpx.routes:
-                print('Route:')
-                for point in route.points:
-                    aws, awd = grib.get_wind_from_grib(point.time, point.latitude, point.longitude)
-                    if point.time not in time_slots:
-                        time_slots[point.time] = {'aws': [], 'awd': []}
-                    time_slots[point.time]['aws'].append(aws)
-                    time_slots[point.time]['awd'].append(awd)
-
-        out_csv.write(f'\n')
-        for t in sorted(time_slots.keys()):
-            out_csv.write(f'{t}')
-            for aws in time_slots[t]["aws"]:
-                if aws is None:
-                    out_csv.write(',')
-                else:
-                    out_csv.write(f',{aws:.1f}')
-            out_csv.write(f'\n')
+    if args.ens_grib is not None:
+        names, speeds, directions = sample_ensemble(args.ens_grib, times, lats, lons)
+    else:
+        names, speeds, directions = sample_grib_dir(args.grib_dir, args.workers, times, lats, lons)
 
+    with open(args.csv_file, 'wt') as out_csv:
+        out_csv.write('UTC' + ''.join(f',{name}' for name in names) + '\n')
+        for t, row in zip(times, speeds):
+            out_csv.write(f'{t.astype(object)}')
+            for aws in row:
+                out_csv.write(',' if np.isnan(aws) else f',{aws:.1f}')
+            out_csv.write('\n')
 
-if __name__ == '__main__':
-    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
-    parser.add_argument("--grib-dir", help="Directory containing GRIB files", required=True)
+    stats = time_slot_stats(speeds, directions)
+    if args.stats_csv is not None:
+        with open(args.stats_csv, 'wt') as out_csv:
+            out_csv.write('UTC,' + ','.join(stats.keys()) + '\n')
+            for n, t in enumerate(times):
+                out_csv.write(f'{t.astype(object)},{stats["count"][n]}' +
+                              ''.join(f',{stats[k][n]:.1f}' for k in stats if k != 'count') + '\n')
+        print(f'{args.stats_csv} created')
+
+    if args.npz_file is not None:
+        np.savez(args.npz_file, utc=times, lat=lats, lon=lons, members=np.array(names), speed=speeds,
+                 direction=directions, **stats)
+        print(f'{args.npz_file} created')
+
+
+def add_arguments(parser):
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--grib-dir", help="Directory containing GRIB files")
+    source.add_argument("--ens-grib", help="Ensemble GRIB, every member is sampled")
     parser.add_argument("--gpx-file", help="GPX file containing the route", required=True)
     parser.add_argument("--csv-file", help="CSV file containing the wind stats", required=True)
-    wind_stat(parser.parse_args())
+    parser.add_argument("--stats-csv", help="CSV file with percentiles, mean direction and spread per time slot",
+                        required=False)
+    parser.add_argument("--npz-file", help="NumPy file with (time x member) speed and direction arrays",
+                        required=False)
+    parser.add_argument("--workers", help="Number of processes", type=int, default=os.cpu_count())
+
+
+def main(args):
+    wind_stat(args)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
+    add_arguments(parser)
+    metrics.add_arguments(parser)
+    metrics.run(parser.parse_args(), main)